@@ -0,0 +1,280 @@
+"""ASGI serving mode.
+
+    uvicorn asgi:application --workers 1
+
+The Flask views stay synchronous: each request is dispatched to a thread of
+a bounded executor, which is where all database access happens. Only the
+view runs there: request bodies are received, and responses are sent, on
+the event loop, so a slow client holds a connection but no thread.
+
+Files given to send_file (avatars, /static) come back as a FileWrapper and
+are streamed in UPLOAD_CHUNK pieces, each read in the executor and sent
+before the next one is read. Servers offering the http.response.pathsend
+extension get the path instead and send the file themselves.
+
+/events streams never end, so they are not iterated in the executor: the
+view leaves an async generator in environ['vw.events'] and it is awaited on
+the loop until the client disconnects. An open feed page costs no thread.
+
+Request bodies are refused with 413 by the bridge itself once they pass
+MAX_CONTENT_LENGTH, declared or not, before any of them reaches Flask.
+
+A response body may be read on a different executor thread for every
+chunk, so each request runs in its own copy of the context variables:
+stream_with_context pushes Flask's contexts there, and later chunks find
+them whichever thread reads them.
+"""
+from asyncio import FIRST_COMPLETED, ensure_future, get_running_loop, wait
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from os import environ as os_environ
+from tempfile import SpooledTemporaryFile
+import sys
+
+from main import UPLOAD_CHUNK, app
+
+
+# request bodies above this are spooled to disk
+SPOOL_SIZE = 1024 * 1024
+
+
+class TooLarge(Exception):
+    pass
+
+
+class FileWrapper:
+    # wsgi.file_wrapper: keeps the file for the ASGI side to stream
+    def __init__(self, file, buffer_size=UPLOAD_CHUNK):
+        self.file = file
+        self.buffer_size = buffer_size
+
+    def __iter__(self):
+        return iter(lambda: self.file.read(self.buffer_size), b'')
+
+    def close(self):
+        self.file.close()
+
+
+def makeEnviron(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode(
+            'latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': FileWrapper,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            key = name
+        else:
+            key = 'HTTP_' + name
+        if key in environ:
+            value = environ[key] + ',' + value
+        environ[key] = value
+    return environ
+
+
+class AsgiApp:
+    def __init__(self, wsgi_app, workers=None, max_body=None):
+        self.wsgi_app = wsgi_app
+        self.max_body = max_body
+        workers = workers or int(os_environ.get('VW_ASGI_THREADS', 16))
+        self.executor = ThreadPoolExecutor(workers,
+                                           thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError('Unsupported ASGI scope: ' + scope['type'])
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def run(self, fn, *args):
+        return get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def runIn(self, context, fn, *args):
+        # chunks of one body run one after another, never at the same time
+        return self.run(context.run, fn, *args)
+
+    async def readBody(self, scope, receive):
+        # -> the body, None on disconnect; TooLarge past max_body
+        declared = dict(scope['headers']).get(b'content-length', b'')
+        if self.max_body is not None and declared.isdigit() and \
+           int(declared) > self.max_body:
+            raise TooLarge()
+        body = SpooledTemporaryFile(SPOOL_SIZE)
+        more = True
+        while more:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None
+            if message.get('body'):
+                if self.max_body is not None and \
+                   body.tell() + len(message['body']) > self.max_body:
+                    body.close()
+                    raise TooLarge()
+                # disk writes only happen past SPOOL_SIZE
+                if body.tell() + len(message['body']) > SPOOL_SIZE:
+                    await self.run(body.write, message['body'])
+                else:
+                    body.write(message['body'])
+            more = message.get('more_body', False)
+        body.seek(0)
+        return body
+
+    async def http(self, scope, receive, send):
+        try:
+            body = await self.readBody(scope, receive)
+        except TooLarge:
+            await self.start(send, ['413 Request Entity Too Large', [
+                ('Content-Type', 'text/plain'), ('Connection', 'close')]])
+            await send({'type': 'http.response.body',
+                        'body': b'Request Entity Too Large'})
+            return
+        if body is None:
+            return
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+
+        try:
+            environ = makeEnviron(scope, body)
+            context = copy_context()
+            body_iter = await self.runIn(context, self.wsgi_app, environ,
+                                         start_response)
+            try:
+                if 'vw.events' in environ:
+                    await self.start(send, started)
+                    await self.streamEvents(receive, send,
+                                            environ['vw.events'])
+                else:
+                    await self.respond(scope, send, started, body_iter,
+                                       context)
+            finally:
+                if hasattr(body_iter, 'close'):
+                    await self.runIn(context, body_iter.close)
+        finally:
+            body.close()
+
+    async def start(self, send, started):
+        status, headers = started
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(name.lower().encode('latin-1'),
+                         value.encode('latin-1'))
+                        for name, value in headers]})
+
+    async def streamEvents(self, receive, send, events):
+        # sends until the stream ends or the client goes away
+        disconnected = ensure_future(self.disconnect(receive))
+        try:
+            while True:
+                chunk = ensure_future(events.__anext__())
+                await wait((chunk, disconnected), return_when=FIRST_COMPLETED)
+                if not chunk.done():
+                    chunk.cancel()
+                    await wait((chunk,))
+                    return
+                try:
+                    data = chunk.result()
+                except StopAsyncIteration:
+                    break
+                await send({'type': 'http.response.body',
+                            'body': data.encode(), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+            await events.aclose()
+
+    async def disconnect(self, receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    async def respond(self, scope, send, started, body_iter, context):
+        if isinstance(body_iter, FileWrapper):
+            chunks = body_iter
+        else:
+            # the first chunk may be what calls start_response
+            chunks = iter(body_iter)
+            first = await self.runIn(context, next, chunks, None)
+            if first is not None:
+                chunks = Chained(first, chunks)
+        await self.start(send, started)
+        if isinstance(chunks, FileWrapper):
+            path = getattr(chunks.file, 'name', None)
+            if isinstance(path, str) and \
+               'http.response.pathsend' in scope.get('extensions', {}):
+                await send({'type': 'http.response.pathsend', 'path': path})
+                return
+            read = chunks.file.read
+            size = chunks.buffer_size
+            while True:
+                data = await self.run(read, size)
+                if not data:
+                    break
+                await send({'type': 'http.response.body', 'body': data,
+                            'more_body': True})
+        else:
+            while True:
+                data = await self.runIn(context, next, chunks, None)
+                if data is None:
+                    break
+                if data:
+                    await send({'type': 'http.response.body', 'body': data,
+                                'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+class Chained:
+    # puts the already read first chunk back in front of the rest
+    def __init__(self, first, rest):
+        self.first = first
+        self.rest = rest
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.first is not None:
+            first, self.first = self.first, None
+            return first
+        return next(self.rest)
+
+
+application = AsgiApp(app, max_body=app.config['MAX_CONTENT_LENGTH'])
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run('asgi:application', host='127.0.0.1', port=8000)
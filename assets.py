@@ -0,0 +1,142 @@
+"""Static asset build step.
+
+Usage: python assets.py
+
+Copies every file under static/ (except uploaded avatars and the output
+itself) to static/dist under a content-hashed name, e.g. img/404.jpg ->
+img/404.<hash>.jpg, after a lossless pass: PNGs are re-encoded with
+Pillow's optimizer and kept only when smaller with identical pixels, JPEGs
+go through jpegtran when it is installed. Text assets also get .gz and,
+with the brotli package, .br siblings. manifest.json maps source paths to
+built ones; templates resolve them through asset() and /static/dist is
+served with immutable caching, see main.dist.
+"""
+from gzip import compress as gzip_compress
+from hashlib import sha256
+from io import BytesIO
+from json import dumps, load
+from os import makedirs, replace, walk
+from os.path import abspath, dirname, exists, join, normpath, relpath, \
+    splitext
+from shutil import which
+from subprocess import run
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+STATIC_DIR = 'static'
+DIST_DIR = join('static', 'dist')
+MANIFEST = 'manifest.json'
+# relative to STATIC_DIR; user uploads are not build inputs
+SKIP = ('dist', join('img', 'av'))
+TEXT_TYPES = ('.css', '.js', '.svg', '.json', '.txt', '.ico')
+# precompressed siblings, in the order they are preferred
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def sources(static_dir):
+    for root, dirs, files in walk(static_dir):
+        rel = relpath(root, static_dir)
+        dirs[:] = sorted(d for d in dirs
+                         if normpath(join(rel, d)) not in SKIP)
+        for name in sorted(files):
+            yield relpath(join(root, name), static_dir)
+
+
+def optimizePng(data):
+    with Image.open(BytesIO(data)) as im:
+        params = {key: im.info[key] for key in ('transparency', 'icc_profile')
+                  if key in im.info}
+        out = BytesIO()
+        im.save(out, format='PNG', optimize=True, **params)
+        with Image.open(BytesIO(out.getvalue())) as check:
+            same = check.convert('RGBA').tobytes() == \
+                im.convert('RGBA').tobytes()
+    if same and out.tell() < len(data):
+        return out.getvalue()
+    return data
+
+
+def optimizeJpeg(data):
+    jpegtran = which('jpegtran')
+    if jpegtran is None:
+        return data
+    result = run([jpegtran, '-copy', 'none', '-optimize', '-progressive'],
+                 input=data, capture_output=True)
+    if result.returncode == 0 and 0 < len(result.stdout) < len(data):
+        return result.stdout
+    return data
+
+
+def optimize(data, ext):
+    if ext == '.png' and Image is not None:
+        return optimizePng(data)
+    if ext in ('.jpg', '.jpeg'):
+        return optimizeJpeg(data)
+    return data
+
+
+def writeFile(path, data):
+    # readers never see a half-written file
+    makedirs(dirname(path), exist_ok=True)
+    with open(path + '.part', 'wb') as f:
+        f.write(data)
+    replace(path + '.part', path)
+
+
+def precompressed(data):
+    found = [('gzip', gzip_compress(data, 9, mtime=0))]
+    if brotli is not None:
+        found.append(('br', brotli.compress(data, quality=11)))
+    return found
+
+
+def build(static_dir=STATIC_DIR, dist_dir=DIST_DIR):
+    # -> manifest; hashed files of earlier builds are kept for pages that
+    # still link them
+    manifest = {}
+    before = after = 0
+    for path in sources(static_dir):
+        with open(join(static_dir, path), 'rb') as f:
+            data = f.read()
+        base, ext = splitext(path)
+        ext = ext.lower()
+        built = optimize(data, ext)
+        name = '%s.%s%s' % (base, sha256(built).hexdigest()[:12], ext)
+        target = join(dist_dir, name)
+        if not exists(target):
+            writeFile(target, built)
+            if ext in TEXT_TYPES:
+                suffixes = dict(ENCODINGS)
+                for kind, packed in precompressed(built):
+                    if len(packed) < len(built):
+                        writeFile(target + suffixes[kind], packed)
+        manifest[path.replace('\\', '/')] = name.replace('\\', '/')
+        before += len(data)
+        after += len(built)
+    writeFile(join(dist_dir, MANIFEST),
+              dumps(manifest, indent=1, sort_keys=True).encode())
+    print('%d assets, %d -> %d bytes' % (len(manifest), before, after))
+    return manifest
+
+
+def loadManifest(dist_dir=DIST_DIR):
+    # {} before the first build; asset() then falls back to /static
+    try:
+        with open(join(dist_dir, MANIFEST)) as f:
+            return load(f)
+    except FileNotFoundError:
+        return {}
+
+
+if __name__ == '__main__':
+    apath = dirname(abspath(__file__))
+    build(join(apath, STATIC_DIR), join(apath, DIST_DIR))
@@ -0,0 +1,91 @@
+"""Avatar upload pipeline.
+
+An upload is decoded once and written as square thumbnails of every size in
+AVATAR_SIZES, named after the sha256 of the uploaded bytes:
+<hash>_<size>.png for still images, plus <hash>_<size>.gif for animated GIFs
+(the .png is then the first frame). GIF frames are decoded one at a time;
+only the first AVATAR_MAX_FRAMES are kept and images over AVATAR_MAX_PIXELS
+are refused. Without Pillow the original file is stored under every size
+name instead, the .png ones included, so links to the first frame resolve
+too (browsers go by the content, not the name).
+"""
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from itertools import islice
+from os import replace
+from os.path import join
+from shutil import copyfile
+
+try:
+    from PIL import Image, ImageSequence
+except ImportError:
+    Image = None
+
+
+AVATAR_DIR = join('static', 'img', 'av')
+AVATAR_SIZES = (50, 200, 512)
+AVATAR_MAX_FRAMES = 60
+# per frame, checked before anything is decoded
+AVATAR_MAX_PIXELS = 16 * 1024 * 1024
+pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='avatars')
+
+
+def fileHash(path):
+    digest = sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:32]
+
+
+def square(im, size):
+    side = min(im.size)
+    left = (im.width - side) // 2
+    top = (im.height - side) // 2
+    im = im.crop((left, top, left + side, top + side))
+    if side > size:
+        im = im.resize((size, size), Image.LANCZOS)
+    return im
+
+
+def atomicSave(im, path, **params):
+    # readers never see a half-written thumbnail
+    im.save(path + '.part', **params)
+    replace(path + '.part', path)
+
+
+def makeThumbnails(src, dest_dir, name):
+    with Image.open(src) as im:
+        if im.width * im.height > AVATAR_MAX_PIXELS:
+            raise ValueError('Avatar too large: %dx%d' % im.size)
+        animated = im.format == 'GIF' and getattr(im, 'n_frames', 1) > 1
+        still = im.convert('RGBA')
+        for size in AVATAR_SIZES:
+            atomicSave(square(still, size),
+                       join(dest_dir, '%s_%d.png' % (name, size)),
+                       format='PNG', optimize=True)
+        if not animated:
+            return 'png'
+        duration = im.info.get('duration', 100)
+        for size in AVATAR_SIZES:
+            # one size at a time; only the small resized frames are kept
+            resized = [square(frame.convert('RGBA'), size) for frame in
+                       islice(ImageSequence.Iterator(im), AVATAR_MAX_FRAMES)]
+            atomicSave(resized[0], join(dest_dir, '%s_%d.gif' % (name, size)),
+                       format='GIF', save_all=True,
+                       append_images=resized[1:], loop=0, disposal=2,
+                       duration=duration, optimize=True)
+        return 'gif'
+
+
+def processAvatar(src, dest_dir, ext):
+    # -> (content hash, av_type) of the stored variants
+    name = fileHash(src)
+    if Image is not None:
+        return name, makeThumbnails(src, dest_dir, name)
+    for size in AVATAR_SIZES:
+        for still in {ext, 'png'}:
+            path = join(dest_dir, '%s_%d.%s' % (name, size, still))
+            copyfile(src, path + '.part')
+            replace(path + '.part', path)
+    return name, ext
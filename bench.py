@@ -0,0 +1,248 @@
+"""Benchmark of the core routes on a synthetic database.
+
+Usage: python bench.py [--scale 1k|100k|1m] [--requests N] [--out FILE]
+
+Seeds a fresh SQLite database (makeDefUsers plus synthetic users, news,
+hidden posts and guild edges, always from the same random seed), then
+requests every route in ROUTES through the Flask test client and through a
+threaded WSGI server, and prints p50/p99 latency, throughput and SQL
+queries per request as JSON. Runs with the same arguments are comparable
+across commits.
+"""
+from argparse import ArgumentParser
+from datetime import datetime
+from http.client import HTTPConnection
+from json import dumps
+from os import environ
+from os.path import join
+from statistics import quantiles
+from subprocess import run
+from tempfile import mkdtemp
+from threading import Thread
+from time import perf_counter
+from urllib.parse import urlencode
+import platform
+import random
+import sqlite3
+import sys
+
+from sqlalchemy import event, insert, text
+from sqlalchemy.engine import Engine
+from werkzeug.serving import make_server
+
+
+SCALES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+CHUNK_SIZE = 10000
+WORDS = ('орда', 'альянс', 'гильдия', 'рейд', 'дракон', 'таверна', 'квест',
+         'золото', 'портал', 'штурм', 'новость', 'турнир')
+# name, path template; {news} is a fresh news id for every request
+ROUTES = [
+    ('index', '/index'),
+    ('wid', '/wid{user}'),
+    ('user_list', '/user_list'),
+    ('guild', '/guild'),
+    ('hidden', '/hidden'),
+    ('hide_news', '/hide_news/{news}'),
+    ('delete_news', '/delete_news/{news}'),
+    ('avatar', '/avatar/{user}'),
+]
+
+
+def chunked(rows):
+    for start in range(0, len(rows), CHUNK_SIZE):
+        yield rows[start:start + CHUNK_SIZE]
+
+
+def seed(vw, news_count):
+    rnd = random.Random(news_count)
+    db = vw.db
+    vw.makeDefUsers(True)
+    users_count = max(news_count // 10, 10)
+    password_hash = vw.credentials.hash('bench')
+    users = [{'user_name': 'bench%d' % i, 'password_hash': password_hash,
+              'fraction': rnd.choice(list(vw.fracs)),
+              'regdate': datetime.now()} for i in range(users_count)]
+    for chunk in chunked(users):
+        db.session.execute(insert(vw.UsersModel), chunk)
+    people = db.session.query(
+        vw.UsersModel.id, vw.UsersModel.user_name,
+        vw.UsersModel.fraction).all()
+    news = []
+    for i in range(news_count):
+        author = rnd.choice(people)
+        news.append({
+            'title': ' '.join(rnd.sample(WORDS, 3)),
+            'content': ' '.join(rnd.choice(WORDS) for _ in range(40)),
+            'user_id': author.id, 'user_name': author.user_name,
+            'date': datetime.now(), 'fraction': vw.fracs[author.fraction],
+            'bgpic': 'info' if author.fraction == 'Альянс' else 'danger'})
+    for chunk in chunked(news):
+        db.session.execute(insert(vw.NewsModel), chunk)
+    hidden = {(rnd.choice(people).id, rnd.randint(1, news_count))
+              for _ in range(news_count // 10)}
+    hidden |= {(1, rnd.randint(1, news_count)) for _ in range(100)}
+    for chunk in chunked([{'user_id': u, 'news_id': n} for u, n in hidden]):
+        db.session.execute(insert(vw.HiddenPostModel), chunk)
+    edges = set()
+    for user in people:
+        other = rnd.choice(people)
+        if other.id != user.id and other.fraction == user.fraction:
+            edges |= {(user.id, other.id), (other.id, user.id)}
+    for other in people[1:51]:
+        if other.fraction == people[0].fraction:
+            edges |= {(1, other.id), (other.id, 1)}
+    for chunk in chunked([{'user_id': u, 'member_id': m} for u, m in edges]):
+        db.session.execute(insert(vw.GuildModel), chunk)
+    db.session.execute(text('''
+        UPDATE users_model SET post_count = counts.n
+        FROM (SELECT user_id, count(*) AS n FROM news_model
+              GROUP BY user_id) AS counts
+        WHERE users_model.id = counts.user_id'''))
+    # the benchmarked viewer; other timelines are built at login
+    vw.buildTimeline(1)
+    db.session.commit()
+    return {'users': len(people), 'news': news_count,
+            'hidden': len(hidden), 'guild_edges': len(edges)}
+
+
+class QueryCounter:
+    # counts SQL statements from every thread while active
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(Engine, 'before_cursor_execute', self)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(Engine, 'before_cursor_execute', self)
+
+
+def summary(timings, queries, elapsed):
+    timings = sorted(timings)
+    cuts = quantiles(timings, n=100) if len(timings) > 1 else timings * 99
+    return {'requests': len(timings),
+            'p50_ms': round(cuts[49] * 1000, 3),
+            'p99_ms': round(cuts[98] * 1000, 3),
+            'rps': round(len(timings) / elapsed, 1),
+            'queries_per_request': round(queries / len(timings), 2)}
+
+
+def paths(template, count, rnd, users, news):
+    return [template.format(user=rnd.randint(1, users), news=next(news))
+            for _ in range(count)]
+
+
+def benchClient(vw, count, users, news):
+    client = vw.app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'admin'})
+    rnd = random.Random(0)
+    results = {}
+    for name, template in ROUTES:
+        todo = paths(template, count, rnd, users, news)
+        counter = QueryCounter()
+        timings = []
+        started = perf_counter()
+        with counter:
+            for path in todo:
+                start = perf_counter()
+                client.get(path).close()
+                timings.append(perf_counter() - start)
+        results[name] = summary(timings, counter.count,
+                                perf_counter() - started)
+    return results
+
+
+def benchServer(vw, count, users, news, concurrency):
+    server = make_server('127.0.0.1', 0, vw.app, threaded=True)
+    Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+    login = HTTPConnection('127.0.0.1', port)
+    login.request('POST', '/login', urlencode(
+        {'username': 'admin', 'password': 'admin'}),
+        {'Content-Type': 'application/x-www-form-urlencoded'})
+    response = login.getresponse()
+    response.read()
+    cookie = response.getheader('Set-Cookie').split(';')[0]
+    rnd = random.Random(1)
+    results = {}
+    for name, template in ROUTES:
+        todo = paths(template, count, rnd, users, news)
+        timings = []
+
+        def worker(part):
+            con = HTTPConnection('127.0.0.1', port)
+            for path in part:
+                start = perf_counter()
+                con.request('GET', path, headers={'Cookie': cookie})
+                con.getresponse().read()
+                timings.append(perf_counter() - start)
+            con.close()
+
+        threads = [Thread(target=worker, args=(todo[i::concurrency],))
+                   for i in range(concurrency)]
+        counter = QueryCounter()
+        started = perf_counter()
+        with counter:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        results[name] = summary(timings, counter.count,
+                                perf_counter() - started)
+    server.shutdown()
+    return results
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark the core VW routes')
+    parser.add_argument('--scale', choices=SCALES, default='1k')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route and driver')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='client threads against the WSGI server')
+    parser.add_argument('--no-server', action='store_true',
+                        help='only use the Flask test client')
+    parser.add_argument('--out', help='write the JSON report here')
+    args = parser.parse_args()
+
+    workdir = mkdtemp(prefix='vw-bench-')
+    environ['VW_DATABASE_URI'] = 'sqlite:///' + join(workdir, 'bench.db')
+    environ.setdefault('VW_LOG_LEVEL', 'WARNING')
+    import main as vw
+    vw.app.config['WTF_CSRF_ENABLED'] = False
+    vw.app.config['SESSION_STORE'] = 'memory'
+    vw.app.session_interface = vw.ServerSessionInterface(
+        vw.makeStore(vw.app.config))
+
+    with vw.app.app_context():
+        started = perf_counter()
+        rows = seed(vw, SCALES[args.scale])
+        seed_seconds = perf_counter() - started
+    # hide_news and delete_news each get their own news ids
+    news = iter(range(SCALES[args.scale], 0, -1))
+    report = {
+        'commit': run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                      text=True).stdout.strip() or None,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'scale': args.scale, 'rows': rows,
+        'seed_seconds': round(seed_seconds, 2),
+        'client': benchClient(vw, args.requests, rows['users'], news),
+    }
+    if not args.no_server:
+        report['server'] = benchServer(vw, args.requests, rows['users'],
+                                       news, args.concurrency)
+    text = dumps(report, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""Response compression.
+
+Text responses (HTML, JSON, CSS, JS, SVG, plain text) are sent with brotli
+when the client accepts it and the brotli package is installed, gzip
+otherwise. Streamed responses are compressed as they are generated: output
+is collected up to COMPRESS_FLUSH_SIZE bytes and then flushed, so the
+browser can paint each part of a long page as it arrives.
+"""
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE = ('text/', 'application/json', 'application/javascript',
+                'image/svg+xml')
+
+
+class GzipStream:
+    def __init__(self, level):
+        # wbits 31: gzip header and trailer
+        self.z = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def chunk(self, data):
+        return self.z.compress(data) + self.z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.z.flush()
+
+
+class BrotliStream:
+    def __init__(self, quality):
+        self.z = brotli.Compressor(quality=quality)
+
+    def chunk(self, data):
+        return self.z.process(data) + self.z.flush()
+
+    def finish(self):
+        return self.z.finish()
+
+
+def encoding():
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return request.accept_encodings.best_match(offered)
+
+
+def compressible(response):
+    if request.method == 'HEAD' or response.status_code < 200 or \
+       response.status_code in (204, 206, 304) or \
+       response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return False
+    # event streams must reach the client as soon as they are written
+    return (response.mimetype or '').startswith(COMPRESSIBLE) and \
+        response.mimetype != 'text/event-stream'
+
+
+def streamed(source, compressor, flush_size):
+    buffered = []
+    size = 0
+    try:
+        for chunk in source:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            buffered.append(chunk)
+            size += len(chunk)
+            if size >= flush_size:
+                yield compressor.chunk(b''.join(buffered))
+                buffered = []
+                size = 0
+        yield compressor.chunk(b''.join(buffered)) + compressor.finish()
+    finally:
+        if hasattr(source, 'close'):
+            source.close()
+
+
+def initCompression(app):
+    app.config.setdefault('COMPRESS_ENABLED', True)
+    app.config.setdefault('COMPRESS_LEVEL', 6)
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', 5)
+    app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+    app.config.setdefault('COMPRESS_FLUSH_SIZE', 2048)
+
+    @app.after_request
+    def compressResponse(response):
+        if not app.config['COMPRESS_ENABLED'] or \
+           not compressible(response):
+            return response
+        response.vary.add('Accept-Encoding')
+        kind = encoding()
+        if kind is None:
+            return response
+        if kind == 'br':
+            compressor = BrotliStream(app.config['COMPRESS_BROTLI_QUALITY'])
+        else:
+            compressor = GzipStream(app.config['COMPRESS_LEVEL'])
+        if response.is_streamed:
+            response.response = streamed(response.response, compressor,
+                                         app.config['COMPRESS_FLUSH_SIZE'])
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < app.config['COMPRESS_MIN_SIZE']:
+                return response
+            response.set_data(compressor.chunk(data) + compressor.finish())
+        response.headers['Content-Encoding'] = kind
+        # the compressed body is another representation of the same data
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
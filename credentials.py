@@ -0,0 +1,127 @@
+"""Password hashing outside the request threads.
+
+Hashes are computed in a small process pool, so a burst of logins keeps the
+KDF off the web workers and out of the GIL. At most max_pending hashes are
+queued or running at once; a request that cannot get a slot within
+queue_timeout gets CredentialsBusy instead of waiting forever. The time
+spent waiting for a slot and for the pool is reported to metrics as
+password_queue, the hashing itself as password_hash.
+
+verify() also tells whether the stored hash was made with other parameters
+than the current method (e.g. an older iteration count), so callers can
+store a fresh hash while they still have the plain password.
+
+The pool is started from a forkserver, not forked from the threaded web
+process (entry scripts need the usual if __name__ == '__main__' guard). It
+is shut down when the process exits, and its workers quit by themselves if
+the process is killed.
+"""
+from atexit import register
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from os import _exit
+from threading import BoundedSemaphore, Lock, Thread
+from time import perf_counter
+
+from werkzeug.security import (DEFAULT_PBKDF2_ITERATIONS,
+                               check_password_hash, generate_password_hash)
+
+from metrics import metrics
+
+
+class CredentialsBusy(Exception):
+    pass
+
+
+def methodPrefix(method):
+    # the '<method>:<params>' part of the hashes werkzeug makes for method,
+    # with its defaults filled in
+    name, *args = method.split(':')
+    if name == 'scrypt':
+        n, r, p = args or (2 ** 15, 8, 1)
+        return 'scrypt:%d:%d:%d' % (int(n), int(r), int(p))
+    if name == 'pbkdf2':
+        hash_name = args[0] if args else 'sha256'
+        iterations = args[1] if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return 'pbkdf2:%s:%d' % (hash_name, int(iterations))
+    raise ValueError('Invalid hash method: ' + method)
+
+
+def watchParent(alive):
+    # pool initializer; alive is the read end of a pipe only the web process
+    # can write to, so EOF means it is gone
+    def wait():
+        try:
+            alive.recv_bytes()
+        except EOFError:
+            pass
+        _exit(0)
+
+    Thread(target=wait, daemon=True).start()
+
+
+def timedHash(password, method):
+    start = perf_counter()
+    return generate_password_hash(password, method), perf_counter() - start
+
+
+def timedCheck(pwhash, password):
+    start = perf_counter()
+    return check_password_hash(pwhash, password), perf_counter() - start
+
+
+class Credentials:
+    def __init__(self, method='scrypt', workers=2, max_pending=8,
+                 queue_timeout=10):
+        self.method = method
+        self.workers = workers
+        self.slots = BoundedSemaphore(max_pending)
+        self.queue_timeout = queue_timeout
+        self.executor = None
+        self.alive = None
+        self.lock = Lock()
+        # '<method>:<params>' part of hashes made now, e.g. scrypt:32768:8:1
+        self.prefix = methodPrefix(method)
+        register(self.shutdown)
+
+    def pool(self):
+        # started on first use, so importing the app starts nothing
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None:
+                    context = get_context('forkserver')
+                    reader, self.alive = context.Pipe(duplex=False)
+                    self.executor = ProcessPoolExecutor(
+                        self.workers, mp_context=context,
+                        initializer=watchParent, initargs=(reader,))
+        return self.executor
+
+    def run(self, fn, *args):
+        queued = perf_counter()
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            raise CredentialsBusy()
+        try:
+            future = self.pool().submit(fn, *args)
+            result, seconds = future.result()
+        finally:
+            self.slots.release()
+        metrics.observe('password_queue', perf_counter() - queued - seconds)
+        metrics.observe('password_hash', seconds)
+        return result
+
+    def hash(self, password):
+        return self.run(timedHash, password, self.method)
+
+    def verify(self, pwhash, password):
+        # -> (matches, a new hash to store or None)
+        if not self.run(timedCheck, pwhash, password):
+            return False, None
+        if pwhash.split('$', 1)[0] != self.prefix:
+            return True, self.hash(password)
+        return True, None
+
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
@@ -0,0 +1,160 @@
+"""Bulk export and import of users, news, hidden posts and guild edges.
+
+Usage: python dump.py [--db vwb.db] [--format jsonl|csv] export|import DIR
+
+export writes users, news, hidden and guild files (.jsonl or .csv) to DIR
+from one read transaction, streaming CHUNK_SIZE rows at a time. import
+loads whichever of those files DIR holds, in that order, with chunked
+executemany inserts inside a single transaction, then recounts post_count,
+rebuilds the search index and resets timelines (they are rebuilt on each
+user's next login). Ids are kept, so a dump can be imported into an empty
+database or next to rows with other ids.
+"""
+from argparse import ArgumentParser
+from json import dumps, loads
+from os import environ, makedirs
+from os.path import abspath, exists, join
+import csv
+import sqlite3
+import sys
+
+from migrate import CHUNK_SIZE, MIGRATIONS, chunks, rebuildSearch, \
+    recountPosts
+from search import NEWS_FTS_DDL
+
+
+# file name, table, columns
+TABLES = [
+    ('users', 'users_model', ['id', 'user_name', 'password_hash', 'fraction',
+                              'regdate', 'av_type', 'av_path']),
+    ('news', 'news_model', ['id', 'title', 'content', 'user_id',
+                            'user_name', 'date', 'fraction', 'bgpic']),
+    ('hidden', 'hidden_post_model', ['user_id', 'news_id']),
+    ('guild', 'guild_model', ['user_id', 'member_id']),
+]
+# empty CSV cells in these columns are NULL
+NULLABLE = {'av_path'}
+# columns not in the dump, recomputed after an import
+FILLED = {'users_model': {'post_count': '0', 'has_timeline': '0',
+                          'feed_version': '0', 'timeline_floor': '0'}}
+
+
+def writeJsonl(f, names, rows):
+    for row in rows:
+        f.write(dumps(dict(zip(names, row)), ensure_ascii=False) + '\n')
+
+
+def writeCsv(f, names, rows):
+    writer = csv.writer(f)
+    writer.writerow(names)
+    writer.writerows(rows)
+
+
+def readJsonl(f, names):
+    for line in f:
+        if line.strip():
+            row = loads(line)
+            yield tuple(row.get(name) for name in names)
+
+
+def readCsv(f, names):
+    for row in csv.DictReader(f):
+        yield tuple(None if name in NULLABLE and row.get(name) == ''
+                    else row.get(name) for name in names)
+
+
+FORMATS = {'jsonl': (writeJsonl, readJsonl), 'csv': (writeCsv, readCsv)}
+
+
+def fetched(cursor):
+    for rows in iter(lambda: cursor.fetchmany(CHUNK_SIZE), []):
+        yield from rows
+
+
+def export(con, directory, fmt):
+    makedirs(directory, exist_ok=True)
+    write = FORMATS[fmt][0]
+    con.execute('BEGIN')
+    try:
+        for name, table, names in TABLES:
+            cursor = con.execute(
+                'SELECT %s FROM %s' % (', '.join(names), table))
+            with open(join(directory, '%s.%s' % (name, fmt)), 'w',
+                      newline='', encoding='utf-8') as f:
+                write(f, names, fetched(cursor))
+            print('exported', name)
+    finally:
+        con.execute('COMMIT')
+
+
+def createSchema(path):
+    # an empty file gets the app's schema, already at the latest migration
+    environ['VW_DATABASE_URI'] = 'sqlite:///' + abspath(path)
+    import main
+    with main.app.app_context():
+        main.db.create_all()
+        main.db.engine.dispose()
+    con = sqlite3.connect(path)
+    con.execute('PRAGMA user_version = %d' % len(MIGRATIONS))
+    con.close()
+
+
+def load(con, directory, fmt):
+    read = FORMATS[fmt][1]
+    con.execute('BEGIN')
+    try:
+        # one rebuild afterwards beats indexing row by row
+        con.execute('DROP TRIGGER IF EXISTS news_fts_ai')
+        for name, table, names in TABLES:
+            path = join(directory, '%s.%s' % (name, fmt))
+            if not exists(path):
+                continue
+            filled = FILLED.get(table, {})
+            sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+                table, ', '.join(names + list(filled)),
+                ', '.join(['?'] * len(names) + list(filled.values())))
+            count = 0
+            with open(path, newline='', encoding='utf-8') as f:
+                for chunk in chunks(read(f, names)):
+                    con.executemany(sql, chunk)
+                    count += len(chunk)
+            print('imported', name, count)
+        bad = con.execute('PRAGMA foreign_key_check').fetchall()
+        if bad:
+            raise SystemExit('%d rows point to missing users or news, '
+                             'first: %r' % (len(bad), bad[0]))
+        con.execute(NEWS_FTS_DDL[1])
+        rebuildSearch(con)
+        recountPosts(con)
+        con.execute('DELETE FROM timeline_model')
+        con.execute('UPDATE users_model SET has_timeline = 0')
+        # cached API pages must not survive an import
+        con.execute('''
+            INSERT INTO counter_model (name, value) VALUES ('news', 1)
+            ON CONFLICT (name) DO UPDATE SET value = value + 1''')
+        con.execute('COMMIT')
+    except BaseException:
+        con.execute('ROLLBACK')
+        raise
+
+
+def main():
+    parser = ArgumentParser(description='Export or import VW data')
+    parser.add_argument('--db', default='vwb.db', help='database file')
+    parser.add_argument('--format', choices=FORMATS, default='jsonl')
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('dir', help='directory of the dump files')
+    args = parser.parse_args()
+    if args.command == 'import' and not exists(args.db):
+        createSchema(args.db)
+    con = sqlite3.connect(args.db, isolation_level=None)
+    if args.command == 'export':
+        export(con, args.dir, args.format)
+    else:
+        load(con, args.dir, args.format)
+    con.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
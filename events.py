@@ -0,0 +1,224 @@
+"""Live feed updates over Server-Sent Events.
+
+Views publish small events through a broker: {'type': 'news' | 'delete',
+'id': news id, 'user_id': author} for everyone, {'type': 'hide' | 'show',
+'id': news id, 'user_id': viewer} for one user's other tabs. The broker
+hands them to the process-wide Hub, which copies each one into the bounded
+queue of every /events subscriber it concerns. Publishers never wait: a
+subscriber whose queue is full is dropped with a final 'reload' event and
+its page falls back to reloading. At most max_subscribers streams are open
+per process; past that /events answers 503 and the page stays static.
+
+Subscriber.stream blocks a thread per open page, which suits threaded WSGI
+servers. Subscriber.astream yields the same text on an event loop without
+holding a thread: asgi.py uses it, woken by publishers through wake.
+
+LocalBroker delivers within one process. SqliteBroker is the stand-in for a
+real message bus between worker processes: events go through a table in a
+shared SQLite file that every process polls. Any object with publish(event)
+and start(hub) fits.
+"""
+from asyncio import Event as AsyncEvent, get_running_loop, wait_for
+from json import dumps, loads
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread, local
+from time import time
+import logging
+import sqlite3
+
+
+RETRY = 'retry: 5000\n\n'
+KEEPALIVE = ': keepalive\n\n'
+
+
+def message(event):
+    if event is None:
+        return 'event: reload\ndata: {}\n\n'
+    return 'event: %s\ndata: %s\n\n' % (event['type'], dumps(event))
+
+
+class Subscriber:
+    def __init__(self, user_id, hidden, size):
+        self.user_id = user_id
+        self.hidden = set(hidden)
+        self.queue = Queue(size)
+        self.dropped = False
+        self.wake = None
+
+    def wants(self, event):
+        if event['type'] in ('hide', 'show'):
+            if event['user_id'] != self.user_id:
+                return False
+            if event['type'] == 'hide':
+                self.hidden.add(event['id'])
+            else:
+                self.hidden.discard(event['id'])
+            return True
+        if event['type'] == 'news' and event['user_id'] == self.user_id:
+            return False
+        return event['id'] not in self.hidden
+
+    def put(self, event):
+        self.queue.put_nowait(event)
+        if self.wake is not None:
+            self.wake()
+
+    def stream(self, keepalive):
+        # SSE text; ends with 'reload' once the subscriber fell behind
+        yield RETRY
+        while True:
+            try:
+                event = self.queue.get(timeout=keepalive)
+            except Empty:
+                yield KEEPALIVE
+                continue
+            yield message(event)
+            if event is None:
+                return
+
+    async def astream(self, keepalive):
+        # stream() for an event loop: waits on wake instead of the queue
+        loop = get_running_loop()
+        ready = AsyncEvent()
+        self.wake = lambda: loop.call_soon_threadsafe(ready.set)
+        yield RETRY
+        while True:
+            ready.clear()
+            try:
+                event = self.queue.get_nowait()
+            except Empty:
+                try:
+                    await wait_for(ready.wait(), keepalive)
+                except TimeoutError:
+                    yield KEEPALIVE
+                continue
+            yield message(event)
+            if event is None:
+                return
+
+
+class Hub:
+    def __init__(self, queue_size=100, max_subscribers=None):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.subscribers = set()
+        self.lock = Lock()
+
+    def subscribe(self, user_id, hidden):
+        # None once max_subscribers streams are open
+        subscriber = Subscriber(user_id, hidden, self.queue_size)
+        with self.lock:
+            if self.max_subscribers is not None and \
+               len(self.subscribers) >= self.max_subscribers:
+                return None
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def dispatch(self, event):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            if subscriber.dropped or not subscriber.wants(event):
+                continue
+            try:
+                subscriber.put(event)
+            except Full:
+                self.drop(subscriber)
+
+    def drop(self, subscriber):
+        # make room for the sentinel; the client reloads the page instead
+        subscriber.dropped = True
+        self.unsubscribe(subscriber)
+        while True:
+            try:
+                while True:
+                    subscriber.queue.get_nowait()
+            except Empty:
+                pass
+            try:
+                subscriber.put(None)
+                return
+            except Full:
+                # another publisher got in between
+                continue
+
+
+class LocalBroker:
+    def __init__(self):
+        self.hub = None
+
+    def start(self, hub):
+        self.hub = hub
+
+    def publish(self, event):
+        if self.hub is not None:
+            self.hub.dispatch(event)
+
+
+class SqliteBroker:
+    # events older than keep seconds are swept on writes
+    def __init__(self, path, interval=0.5, keep=60, sweep_every=100):
+        self.path = path
+        self.interval = interval
+        self.keep = keep
+        self.sweep_every = sweep_every
+        self.writes = 0
+        self.connections = local()
+        self.stopped = Event()
+        self.connect().execute('''
+            CREATE TABLE IF NOT EXISTS event (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                data TEXT NOT NULL,
+                created REAL NOT NULL
+            )''')
+
+    def connect(self):
+        con = getattr(self.connections, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.path, timeout=10,
+                                  isolation_level=None)
+            con.execute('PRAGMA journal_mode=WAL')
+            self.connections.con = con
+        return con
+
+    def publish(self, event):
+        con = self.connect()
+        con.execute('INSERT INTO event (data, created) VALUES (?, ?)',
+                    (dumps(event), time()))
+        self.writes += 1
+        if self.writes % self.sweep_every == 0:
+            con.execute('DELETE FROM event WHERE created < ?',
+                        (time() - self.keep,))
+
+    def start(self, hub):
+        Thread(target=self.poll, args=(hub,), daemon=True,
+               name='events').start()
+
+    def poll(self, hub):
+        con = self.connect()
+        last = con.execute(
+            'SELECT coalesce(max(id), 0) FROM event').fetchone()[0]
+        while not self.stopped.wait(self.interval):
+            try:
+                rows = con.execute('SELECT id, data FROM event WHERE id > ? '
+                                   'ORDER BY id', (last,)).fetchall()
+                for last, data in rows:
+                    hub.dispatch(loads(data))
+            except Exception:
+                logging.exception('Polling events failed')
+
+    def stop(self):
+        self.stopped.set()
+
+
+def makeBroker(config):
+    kind = config['EVENTS_BROKER']
+    if kind == 'local':
+        return LocalBroker()
+    elif kind == 'sqlite':
+        return SqliteBroker(config['EVENTS_DB'])
+    raise ValueError('Unknown EVENTS_BROKER: ' + str(kind))
@@ -1,32 +1,157 @@
-from flask import Flask, redirect, render_template, session, request, send_file
+from flask import (Flask, Response, redirect, render_template, session,
+                   request, send_file, abort, g, jsonify, make_response,
+                   send_from_directory, stream_template, url_for)
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import (DDL, create_engine, event, insert, inspect, literal,
+                        select, text, func, and_, or_, tuple_)
+from sqlalchemy.dialects.sqlite import insert as upsert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import defer, scoped_session, sessionmaker
 from flask_wtf import FlaskForm
+from markupsafe import Markup
 from wtforms import (StringField, PasswordField, BooleanField, SubmitField,
                      SelectField, TextAreaField)
 from wtforms.validators import (DataRequired, ValidationError, EqualTo,
                                 StopValidation)
 from flask_wtf.file import FileField, FileRequired, FileAllowed
-from os.path import join, exists, abspath, dirname
+from os import close, environ, makedirs, remove
+from os.path import join, abspath, basename, dirname, isfile
+from mimetypes import guess_type
+from tempfile import gettempdir, mkstemp
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from json import loads, dumps
-from time import time, ctime
+from hashlib import sha1
+from threading import Lock
 import logging
-
-
-logging.basicConfig(level=logging.DEBUG)
+import sqlite3
+
+from assets import DIST_DIR, ENCODINGS, loadManifest
+from avatars import AVATAR_DIR, AVATAR_SIZES, processAvatar
+from avatars import pool as avatar_pool
+from credentials import Credentials, CredentialsBusy
+from search import NEWS_FTS_DDL, NEWS_FTS_DROP, NEWS_FTS_SEARCH, ftsQuery
+from sessions import ServerSessionInterface, makeStore
+from metrics import initMetrics
+from migrate import (MIGRATIONS, TIMELINE_BUILT, TIMELINE_FLOOR,
+                     TIMELINE_SIZE, TIMELINE_TRIM, TIMELINE_TRIM_EVERY,
+                     migrate)
+from compress import initCompression
+from events import Hub, makeBroker
+from writebehind import WriteBehind
+
+
+logging.basicConfig(level=environ.get('VW_LOG_LEVEL', 'INFO'))
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'yandexlyceum_secret_key'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///vwb.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = environ.get('VW_DATABASE_URI',
+                                                    'sqlite:///vwb.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = '/static/img'
+# '/internal/' to let nginx send avatars (X-Accel-Redirect); for Apache's
+# X-Sendfile set USE_X_SENDFILE instead
+app.config['AVATAR_ACCEL_REDIRECT'] = None
+# uploads wait here for avatar_pool; must not be under static/
+app.config['UPLOAD_SPOOL_DIR'] = gettempdir()
+# where sessions live: 'sqlite' (SESSION_DB, shared between workers),
+# 'memory' (one process) or 'kv' (the in-process stand-in for a redis-like
+# store; pass a real client to sessions.KVStore in production)
+app.config['SESSION_STORE'] = 'sqlite'
+# unchanged sessions are written back at most this often to renew their ttl
+app.config['SESSION_TOUCH_INTERVAL'] = 3600
+# per-route query/template/latency profiling, see metrics.py
+app.config['METRICS_ENABLED'] = bool(environ.get('VW_METRICS'))
+app.config['METRICS_SERVER_TIMING'] = bool(environ.get('VW_SERVER_TIMING'))
+# password hashing runs in a process pool, see credentials.py; hashes made
+# with other parameters than PASSWORD_METHOD are replaced on the next login
+app.config['PASSWORD_METHOD'] = 'scrypt'
+app.config['PASSWORD_WORKERS'] = 2
+app.config['PASSWORD_MAX_PENDING'] = 8
 apath = dirname(abspath(__file__))
+makedirs(join(apath, AVATAR_DIR), exist_ok=True)
+app.config['SESSION_DB'] = join(apath, 'sessions.db')
+app.session_interface = ServerSessionInterface(
+    makeStore(app.config), app.config['SESSION_TOUCH_INTERVAL'])
+# live feed updates (/events): 'local' for one process, 'sqlite' (EVENTS_DB)
+# to share them between worker processes
+app.config['EVENTS_BROKER'] = 'local'
+app.config['EVENTS_DB'] = join(apath, 'events.db')
+app.config['EVENTS_QUEUE_SIZE'] = 100
+app.config['EVENTS_KEEPALIVE'] = 15
+# open /events streams per process; each holds a server thread under WSGI
+app.config['EVENTS_MAX_SUBSCRIBERS'] = 64
+# hide_news writes are collected for this many seconds and flushed in one
+# transaction; 0 writes them straight away
+app.config['HIDE_BUFFER_DELAY'] = 0.5
+event_hub = Hub(app.config['EVENTS_QUEUE_SIZE'],
+                app.config['EVENTS_MAX_SUBSCRIBERS'])
+broker = makeBroker(app.config)
+broker.start(event_hub)
+initMetrics(app)
+initCompression(app)
+credentials = Credentials(app.config['PASSWORD_METHOD'],
+                          app.config['PASSWORD_WORKERS'],
+                          app.config['PASSWORD_MAX_PENDING'])
 forbidden_names = ['admin', 'default', 'Zaicol']
 MAX_FILE_SIZE = 1024 * 1024 * 8 * 4 + 1
+UPLOAD_CHUNK = 64 * 1024
+# jpg, png, gif
+IMAGE_SIGNATURES = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n',
+                    b'GIF87a', b'GIF89a')
+NEWS_PAGE_SIZE = 20
+API_PAGE_SIZE = 100
+USERS_PAGE_SIZE = 50
+AVATAR_MAX_AGE = 365 * 24 * 60 * 60
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+CARD_CACHE_SIZE = 4096
+# users whose timelines get a new news in one fanOut transaction
+TIMELINE_FANOUT_BATCH = 500
 fracs = {
     'Альянс': 'A', 'Орда': 'H'
 }
+DEFAULT_LOGO = 'D'
+DEFAULT_BGPIC = 'secondary'
+# bigger requests are refused with 413 before the body is read
+app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE + UPLOAD_CHUNK
+# set on every SQLite connection; WAL lets readers run during a write and
+# busy_timeout makes writers queue for the lock instead of failing
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'foreign_keys': 'ON',
+    'busy_timeout': 15000,
+    'cache_size': -32000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+if ':memory:' not in app.config['SQLALCHEMY_DATABASE_URI'] and \
+   app.config['SQLALCHEMY_DATABASE_URI'] != 'sqlite://':
+    # per worker process; a thread holds one connection per request
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(environ.get('VW_DB_POOL_SIZE', 8)),
+        'max_overflow': 8,
+        'pool_timeout': 30,
+        'connect_args': {'timeout': 15},
+    }
+else:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {}
+# send feed reads through feedEngine()
+app.config['SQLITE_READONLY_FEED'] = True
 db = SQLAlchemy(app)
+feed_engine = None
+feed_lock = Lock()
+feed_session = scoped_session(sessionmaker())
+# rendered news cards: (news id, date) -> {(kind, link): Markup}, least
+# recent first; SQLite hands a deleted newest id out again, the date tells
+# the posts apart in every worker, whichever one served the delete
+card_cache = OrderedDict()
+card_lock = Lock()
+# source path -> content-hashed path in DIST_DIR, written by assets.py
+asset_manifest = loadManifest(join(apath, DIST_DIR))
+# one worker, so new news reach the timelines in the order they were added
+timeline_pool = ThreadPoolExecutor(max_workers=1,
+                                   thread_name_prefix='timelines')
 
 
 def user_check(form, field):
@@ -34,9 +159,15 @@ def user_check(form, field):
         check = UsersModel.query.filter_by(
             user_name=form.username.data).first()
         if check:
-            if not check_password_hash(check.password_hash, field.data):
+            ok, rehash = credentials.verify(check.password_hash, field.data)
+            if not ok:
                 raise ValidationError(
                     'Неверный пароль')
+            if rehash:
+                # login() commits it
+                check.password_hash = rehash
+            # login() takes the user from here instead of a second query
+            form.user = check
         else:
             raise ValidationError('Такого пользователя не существует')
 
@@ -81,10 +212,18 @@ class AddNewsForm(FlaskForm):
 
 
 def size_check(form, field):
+    # reads the upload in small chunks and rewinds it for f.save
     file = field.data
-    file_bytes = file.read(MAX_FILE_SIZE)
-    if len(file_bytes) == MAX_FILE_SIZE:
-        raise StopValidation('Превышен максиммальный размер файла')
+    head = file.read(UPLOAD_CHUNK)
+    if not head.startswith(IMAGE_SIGNATURES):
+        raise StopValidation('Файл не является изображением')
+    size = len(head)
+    while head:
+        if size >= MAX_FILE_SIZE:
+            raise StopValidation('Превышен максиммальный размер файла')
+        head = file.read(UPLOAD_CHUNK)
+        size += len(head)
+    file.seek(0)
 
 
 class AvatarForm(FlaskForm):
@@ -111,8 +250,8 @@ class ChangeUsernameForm(FlaskForm):
 
 
 def oldpass_check(form, field):
-    user = UsersModel.query.filter_by(id=session["user_id"]).first()
-    if not check_password_hash(user.password_hash, field.data):
+    user = currentUser()
+    if not credentials.verify(user.password_hash, field.data)[0]:
         raise ValidationError('Неверный пароль')
 
 
@@ -131,26 +270,40 @@ class ChangePasswordForm(FlaskForm):
 class UsersModel(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_name = db.Column(db.String(50), unique=True, nullable=False)
-    password_hash = db.Column(db.String(128), unique=False, nullable=False)
-    # hidden posts
-    hdp = db.Column(db.String(), unique=False, nullable=True, default='[]')
+    password_hash = db.Column(db.String(255), unique=False, nullable=False)
     fraction = db.Column(db.String(6), unique=False, nullable=False)
     regdate = db.Column(db.DateTime, unique=False, nullable=False)
-    coguild = db.Column(db.String(), unique=False, nullable=True, default='[]')
     av_type = db.Column(db.String(4), unique=False,
                         nullable=False, default='png')
-
-    def getHDP(self):
-        return list(map(int, loads(self.hdp)))
+    # AVATAR_DIR/<content hash> of the uploaded avatar, see getAvat;
+    # NULL means the faction default
+    av_path = db.Column(db.String(100), unique=False, nullable=True)
+    # kept in step with news_model by add_news/delete_news
+    post_count = db.Column(db.Integer, unique=False, nullable=False,
+                           default=0)
+    # whether timeline_model holds this user's feed, see buildTimeline
+    has_timeline = db.Column(db.Boolean, unique=False, nullable=False,
+                             default=False)
+    # the timeline is complete from this news id up, 0 for all of it
+    timeline_floor = db.Column(db.Integer, unique=False, nullable=False,
+                               default=0)
+    # bumped when the user hides or shows news, see feedEtag
+    feed_version = db.Column(db.Integer, unique=False, nullable=False,
+                             default=0)
 
 
 class NewsModel(db.Model):
+    # (user_id, id) serves profile pages, title the alphabetical feed
+    __table_args__ = (db.Index('ix_news_model_user_id_id', 'user_id', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
-    title = db.Column(db.String(100), unique=False, nullable=False)
+    title = db.Column(db.String(100), unique=False, nullable=False,
+                      index=True)
     content = db.Column(db.String(1000), unique=False, nullable=False)
-    user_id = db.Column(db.Integer, unique=False, nullable=False)
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey('users_model.id', ondelete='CASCADE'),
+                        unique=False, nullable=False)
     user_name = db.Column(db.String(50), unique=False, nullable=False)
-    date = db.Column(db.String(50), unique=False, nullable=False)
+    date = db.Column(db.DateTime, unique=False, nullable=False, index=True)
     fraction = db.Column(db.String(1), unique=False, nullable=False)
     bgpic = db.Column(db.String(15), unique=False, nullable=False)
 
@@ -159,52 +312,382 @@ class NewsModel(db.Model):
                                                    self.title, self.user_id)
 
 
-def getAvat(user, avtype='png', username=False):
-    if username:
-        user_id = user
-    else:
-        user_id = str(user.id)
-    if exists(join(apath, 'static', 'img', user_id + '_av.' + avtype)) or \
-       exists(join('static', 'img', user_id + '_av.' + avtype)):
-        return join('static', 'img', user_id + '_av.' + avtype)
-    else:
-        return join('static', 'img',
-                    fracs[user.fraction] + '_default_av.png')
-
-
-def getHiddenNews():
-    hdp = UsersModel.query.filter_by(id=session["user_id"]).first().getHDP()
-    news = list(NewsModel.query.all())
-    ts = news[:]
-    for item in ts:
-        if item.id not in hdp:
-            news.remove(item)
-    if session['news_sort_type']:
-        news.sort(key=lambda n: n.id, reverse=session["reverse"])
+for ddl in NEWS_FTS_DDL:
+    event.listen(NewsModel.__table__, 'after_create', DDL(ddl))
+event.listen(NewsModel.__table__, 'before_drop', DDL(NEWS_FTS_DROP))
+
+
+class HiddenPostModel(db.Model):
+    # hidden posts, one row per (user, news) pair
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey('users_model.id', ondelete='CASCADE'),
+                        primary_key=True)
+    news_id = db.Column(db.Integer,
+                        db.ForeignKey('news_model.id', ondelete='CASCADE'),
+                        primary_key=True, index=True)
+
+
+class TimelineModel(db.Model):
+    # materialized /index feed: the newest TIMELINE_SIZE news the user has
+    # not hidden, with the title copied so both feed orders are read
+    # straight off an index
+    __table_args__ = (
+        db.Index('ix_timeline_model_user_id_title_news_id',
+                 'user_id', 'title', 'news_id'),)
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey('users_model.id', ondelete='CASCADE'),
+                        primary_key=True)
+    news_id = db.Column(db.Integer,
+                        db.ForeignKey('news_model.id', ondelete='CASCADE'),
+                        primary_key=True, index=True)
+    title = db.Column(db.String(100), unique=False, nullable=False)
+
+
+class CounterModel(db.Model):
+    # named counters; 'news' goes up with every added or deleted news
+    name = db.Column(db.String(20), primary_key=True)
+    value = db.Column(db.Integer, unique=False, nullable=False, default=0)
+
+
+@event.listens_for(Engine, 'connect')
+def sqlitePragmas(dbapi_connection, connection_record):
+    # SQLITE_PRAGMAS are per connection, so they are set on every new one
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        for name, value in app.config['SQLITE_PRAGMAS'].items():
+            cursor.execute('PRAGMA %s=%s' % (name, value))
+        cursor.close()
+
+
+def readOnly(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA query_only=ON')
+    cursor.close()
+
+
+def feedEngine():
+    # a separate read-only pool for feed queries; with WAL they run next to
+    # the writers instead of waiting for them
+    global feed_engine
+    with feed_lock:
+        if feed_engine is None:
+            url = db.engine.url
+            if not app.config['SQLITE_READONLY_FEED'] or \
+               url.get_backend_name() != 'sqlite' or \
+               url.database in (None, '', ':memory:'):
+                engine = db.engine
+            else:
+                engine = create_engine(
+                    url, **app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+                event.listen(engine, 'connect', readOnly)
+            feed_session.configure(bind=engine)
+            feed_engine = engine
+    return feed_engine
+
+
+def feedSession():
+    feedEngine()
+    return feed_session
+
+
+def feedQuery(*entities):
+    return feedSession().query(*entities)
+
+
+@app.teardown_appcontext
+def closeFeed(exception=None):
+    feed_session.remove()
+
+
+class GuildModel(db.Model):
+    # guild membership, stored in both directions
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey('users_model.id', ondelete='CASCADE'),
+                        primary_key=True)
+    member_id = db.Column(db.Integer,
+                          db.ForeignKey('users_model.id', ondelete='CASCADE'),
+                          primary_key=True, index=True)
+
+
+def currentUser():
+    # the viewer, loaded once per request and shared by views and validators
+    if 'user' not in g:
+        g.user = UsersModel.query.options(
+            defer(UsersModel.password_hash)).filter_by(
+            id=session["user_id"]).first()
+    return g.user
+
+
+@contextmanager
+def queryBudget(limit):
+    # with queryBudget(3): client.get('/index') -- fails on a 4th query
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(Engine, 'before_cursor_execute', count)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, 'before_cursor_execute', count)
+    assert len(statements) <= limit, '%d queries over a budget of %d:\n%s' % (
+        len(statements), limit, '\n'.join(statements))
+
+
+def hiddenIds(user_id):
+    return select(HiddenPostModel.news_id).where(
+        HiddenPostModel.user_id == user_id)
+
+
+def writeHidden(pending):
+    # flushes hidden_buffer: {user id: news ids}, one transaction for all
+    with app.app_context():
+        for user_id, news_ids in pending.items():
+            db.session.execute(
+                insert(HiddenPostModel).prefix_with('OR IGNORE').from_select(
+                    ['user_id', 'news_id'],
+                    select(literal(user_id), NewsModel.id).where(
+                        NewsModel.id.in_(news_ids))))
+            TimelineModel.query.filter(
+                TimelineModel.user_id == user_id,
+                TimelineModel.news_id.in_(news_ids)).delete(
+                synchronize_session=False)
+            bumpFeed(user_id)
+        db.session.commit()
+
+
+hidden_buffer = WriteBehind(writeHidden, app.config['HIDE_BUFFER_DELAY'])
+
+
+def notHidden(user_id, column=NewsModel.id):
+    # column's news are not hidden by the user, counting unflushed hides
+    pending = hidden_buffer.get(user_id)
+    cond = column.notin_(hiddenIds(user_id))
+    return and_(cond, column.notin_(pending)) if pending else cond
+
+
+def isHidden(user_id, column=NewsModel.id):
+    pending = hidden_buffer.get(user_id)
+    cond = column.in_(hiddenIds(user_id))
+    return or_(cond, column.in_(pending)) if pending else cond
+
+
+def buildTimeline(user_id):
+    # fills the user's timeline from news_model; fanOut, hide_news and
+    # show_news keep it up to date from then on
+    db.session.execute(
+        insert(TimelineModel).prefix_with('OR IGNORE').from_select(
+            ['user_id', 'news_id', 'title'],
+            select(literal(user_id), NewsModel.id, NewsModel.title).where(
+                NewsModel.id.notin_(hiddenIds(user_id))).order_by(
+                NewsModel.id.desc()).limit(TIMELINE_SIZE)))
+    db.session.execute(text(TIMELINE_BUILT), {
+        'lo': user_id, 'hi': user_id, 'size': TIMELINE_SIZE})
+
+
+def fanOut(news_id, title, author_id):
+    # runs on timeline_pool once add_news has committed: the news goes into
+    # every built timeline, TIMELINE_FANOUT_BATCH users per transaction so
+    # other writers get the lock in between; open pages hear of it after
+    try:
+        trim = news_id % TIMELINE_TRIM_EVERY == 0
+        with app.app_context():
+            last = 0
+            while True:
+                users = db.session.execute(
+                    select(UsersModel.id).where(
+                        UsersModel.has_timeline,
+                        UsersModel.id > last).order_by(UsersModel.id).limit(
+                        TIMELINE_FANOUT_BATCH)).scalars().all()
+                if not users:
+                    break
+                span = {'lo': users[0], 'hi': users[-1],
+                        'size': TIMELINE_SIZE}
+                db.session.execute(
+                    insert(TimelineModel).prefix_with('OR IGNORE').from_select(
+                        ['user_id', 'news_id', 'title'],
+                        select(UsersModel.id, literal(news_id),
+                               literal(title)).where(
+                            UsersModel.has_timeline,
+                            UsersModel.id.between(users[0], users[-1]),
+                            UsersModel.id.notin_(
+                                select(HiddenPostModel.user_id).where(
+                                    HiddenPostModel.news_id == news_id)),
+                            select(NewsModel.id).where(
+                                NewsModel.id == news_id).exists())))
+                if trim:
+                    db.session.execute(text(TIMELINE_FLOOR), span)
+                    db.session.execute(text(TIMELINE_TRIM), span)
+                db.session.commit()
+                last = users[-1]
+            # API pages read before this commit must not stay valid
+            bumpCounter('news')
+            db.session.commit()
+    except Exception:
+        logging.exception('Timeline fan-out failed: ' + str(news_id))
+    broker.publish({'type': 'news', 'id': news_id, 'user_id': author_id})
+
+
+def bumpCounter(name):
+    db.session.execute(upsert(CounterModel).values(
+        name=name, value=1).on_conflict_do_update(
+        index_elements=['name'], set_={'value': CounterModel.value + 1}))
+
+
+def bumpFeed(user_id):
+    UsersModel.query.filter_by(id=user_id).update(
+        {UsersModel.feed_version: UsersModel.feed_version + 1})
+
+
+def getAvat(user, size=200, still=False):
+    # still: the first-frame PNG of animated avatars
+    if user.av_path:
+        return '%s_%d.%s' % (user.av_path, size,
+                             'png' if still else user.av_type)
+    return join('static', 'img', fracs[user.fraction] + '_default_av.png')
+
+
+def feedOrder(by_id=None, reverse=None):
+    # -> (by_id, reverse), from the session unless given
+    if reverse is None:
+        reverse = session.get('reverse', False)
+    if by_id is None:
+        by_id = session.get('news_sort_type')
+    return bool(by_id), bool(reverse)
+
+
+def newsQuery(query, after=None, title=NewsModel.title, news_id=NewsModel.id,
+              by_id=None, reverse=None, last=None):
+    # id/title ordering, from the session unless by_id/reverse are given,
+    # keyset-paginated by news id; title and news_id are the columns to
+    # sort on, last the news after is the id of when already loaded
+    by_id, reverse = feedOrder(by_id, reverse)
+    if by_id:
+        keys = [news_id]
+        fields = ['id']
     else:
-        news.sort(key=lambda n: n.title, reverse=session["reverse"])
+        keys = [title, news_id]
+        fields = ['title', 'id']
+    if after is not None:
+        if last is None:
+            last = feedQuery(NewsModel).filter_by(id=after).first()
+        if last:
+            values = [getattr(last, field) for field in fields]
+            if len(keys) == 1:
+                cond = keys[0] < values[0] if reverse else keys[0] > values[0]
+            else:
+                cond = tuple_(*keys) < tuple_(*values) if reverse else \
+                    tuple_(*keys) > tuple_(*values)
+            query = query.filter(cond)
+    if reverse:
+        keys = [key.desc() for key in keys]
+    return query.order_by(*keys)
+
+
+def pageQuery(query, after=None, size=NEWS_PAGE_SIZE, **order):
+    # one row more than the page, to tell whether there is a next one
+    return newsQuery(query, after, **order).limit(size + 1)
+
+
+def getPage(query, after=None, size=NEWS_PAGE_SIZE, **order):
+    news = pageQuery(query, after, size, **order).all()
+    next_page = None
+    if len(news) > size:
+        news = news[:size]
+        next_page = news[-1].id
+    return news, next_page
+
+
+def avatarVersion(user):
+    if user.av_path:
+        return basename(user.av_path)
+    return fracs[user.fraction] + '_default_av'
+
+
+def avatarUrl(user):
+    return '/avatar/%d?v=%s' % (user.id, avatarVersion(user))
+
+
+def saveAvatar(user_id, tmp, ext):
+    # runs on avatar_pool; the new avatar shows up once this commits
+    try:
+        name, av_type = processAvatar(tmp, join(apath, AVATAR_DIR), ext)
+        with app.app_context():
+            UsersModel.query.filter_by(id=user_id).update({
+                UsersModel.av_path: join(AVATAR_DIR, name),
+                UsersModel.av_type: av_type})
+            db.session.commit()
+    except Exception:
+        logging.exception('Avatar upload failed: ' + str(user_id))
+    finally:
+        remove(tmp)
+
+
+def visibleNews(user_id):
+    # news the user has not hidden
+    return feedQuery(NewsModel).filter(notHidden(user_id))
+
+
+def hiddenNews(user_id):
+    return feedQuery(NewsModel).filter(isHidden(user_id))
+
+
+def timelineNews(user_id):
+    # the user's timeline; sort it with TIMELINE_ORDER
+    news = feedQuery(NewsModel).join(
+        TimelineModel, TimelineModel.news_id == NewsModel.id).filter(
+        TimelineModel.user_id == user_id)
+    pending = hidden_buffer.get(user_id)
+    if pending:
+        news = news.filter(TimelineModel.news_id.notin_(pending))
     return news
 
 
-def getNews(user=False):
+TIMELINE_ORDER = {'title': TimelineModel.title,
+                  'news_id': TimelineModel.news_id}
+
+
+def getHiddenNews(after=None):
+    return getPage(hiddenNews(session["user_id"]), after)
+
+
+def inTimeline(viewer, after, by_id, reverse):
+    # whether the page can be read off the viewer's timeline: any page of
+    # a complete one, id-ordered pages from its floor up otherwise (newest
+    # first is checked for running past the floor afterwards)
+    if not viewer.has_timeline:
+        return False
+    if not viewer.timeline_floor:
+        return True
+    if not by_id:
+        return False
+    return reverse or (after is not None and after >= viewer.timeline_floor)
+
+
+def getFeed(after=None, size=NEWS_PAGE_SIZE, **order):
+    # the viewer's /index feed, walked along their timeline index where it
+    # covers the page, along news_model's otherwise
+    viewer = currentUser()
+    by_id, reverse = feedOrder(**order)
+    if inTimeline(viewer, after, by_id, reverse):
+        news, next_page = getPage(timelineNews(viewer.id), after, size,
+                                  by_id=by_id, reverse=reverse,
+                                  **TIMELINE_ORDER)
+        if next_page is not None or not viewer.timeline_floor:
+            return news, next_page
+    return getPage(visibleNews(viewer.id), after, size, by_id=by_id,
+                   reverse=reverse)
+
+
+def getNews(user=False, after=None):
     if 'news_sort_type' not in session:
         session["news_sort_type"] = False
-    hdp = UsersModel.query.filter_by(id=session["user_id"]).first().getHDP()
     if user:
-        news = NewsModel.query.filter_by(user_id=user)
-        news = news.filter(NewsModel.id not in hdp)
+        news, next_page = getPage(visibleNews(session["user_id"]).filter_by(
+            user_id=user), after)
     else:
-        news = NewsModel.query.filter(NewsModel.id not in hdp)
-    news = list(news.filter(NewsModel.id not in hdp))
-    ts = news[:]
-    for n in ts:
-        if n.id in hdp:
-            logging.debug('Remove: ' + str(n.id))
-            news.remove(n)
-    if session['news_sort_type']:
-        news.sort(key=lambda n: n.id, reverse=session["reverse"])
-    else:
-        news.sort(key=lambda n: n.title, reverse=session["reverse"])
+        news, next_page = getFeed(after)
     news_link = {}
     for n in news:
         news_link[n.id] = {}
@@ -214,7 +697,68 @@ def getNews(user=False):
         else:
             news_link[n.id]['link'] = 'hide_news'
             news_link[n.id]['desc'] = 'Скрыть новость'
-    return news, news_link
+    return news, news_link, next_page
+
+
+def newsCard(item, kind, link=None):
+    # a card only depends on the post and the link shown under it
+    key = (kind, link['link'] if link else None)
+    post = (item.id, item.date)
+    with card_lock:
+        cards = card_cache.get(post)
+        if cards is not None:
+            card_cache.move_to_end(post)
+            if key in cards:
+                return cards[key]
+    card = Markup(app.jinja_env.get_template('news_card.html').render(
+        item=item, kind=kind, **(link or {})))
+    with card_lock:
+        card_cache.setdefault(post, {})[key] = card
+        if len(card_cache) > CARD_CACHE_SIZE:
+            card_cache.popitem(last=False)
+    return card
+
+
+class LazyPage:
+    # a page of cards loaded when a streamed template first reaches it, so
+    # the top of the page is on its way before the feed query runs;
+    # load() -> (cards, next_page)
+    def __init__(self, load):
+        self.load = load
+        self.loaded = None
+
+    def fetch(self):
+        if self.loaded is None:
+            self.loaded = self.load()
+        return self.loaded
+
+    @property
+    def cards(self):
+        return self.fetch()[0]
+
+    @property
+    def next_page(self):
+        return self.fetch()[1]
+
+
+def dropCards(item):
+    with card_lock:
+        card_cache.pop((item.id, item.date), None)
+
+
+@app.template_global()
+def asset(path):
+    # built, cache-forever URL when assets.py has run, plain /static if not
+    if path in asset_manifest:
+        return url_for('dist', filename=asset_manifest[path])
+    return url_for('static', filename=path)
+
+
+@app.context_processor
+def fractionStyle():
+    # anonymous visitors get the neutral look without touching the session
+    return {'logo': session.get('logo', DEFAULT_LOGO),
+            'bgpic': session.get('bgpic', DEFAULT_BGPIC)}
 
 
 @app.route('/')
@@ -222,23 +766,27 @@ def getNews(user=False):
 def index():
     if 'username' not in session:
         return redirect('/login')
-    news, news_link = getNews()
-    return render_template(
+    after = request.args.get('after', type=int)
+
+    def load():
+        news, news_link, next_page = getNews(after=after)
+        return (newsCard(n, 'index', news_link[n.id])
+                for n in news), next_page
+
+    return stream_template(
         'index.html', title='ВВаркрафте',
-        username=session['username'], news=news, nl=news_link)
+        username=session['username'], page=LazyPage(load))
 
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if "username" in session:
         return redirect('/0')
-    session["logo"] = "D"
-    session['bgpic'] = "secondary"
     form = RegistrationForm()
     if form.validate_on_submit():
         user = UsersModel(
             user_name=form.username.data,
-            password_hash=generate_password_hash(form.password.data),
+            password_hash=credentials.hash(form.password.data),
             fraction=form.fraction.data,
             regdate=datetime.now())
         db.session.add(user)
@@ -252,17 +800,21 @@ def login():
     if "username" in session:
         return redirect('/0')
     form = LoginForm()
-    session["logo"] = "D"
-    session['bgpic'] = "secondary"
-    session["apath"] = apath
     if form.validate_on_submit():
-        user = UsersModel.query.filter_by(
-            user_name=form.username.data).first()
+        user = form.user
+        # the feed's timeline is built here rather than by a GET of /index
+        build = not user.has_timeline
+        if build:
+            buildTimeline(user.id)
+        if build or user in db.session.dirty:
+            db.session.commit()
+        # a session id known before the login must not carry it
+        session.regenerate()
         session['username'] = user.user_name
         session['user_id'] = user.id
         session['news_sort_type'] = False
         session['reverse'] = False
-        session["pic"] = getAvat(user, user.av_type)
+        session["pic"] = getAvat(user, 50, still=True)
         if user.fraction == "Альянс":
             session["logo"] = "A"
             session['bgpic'] = 'info'
@@ -285,11 +837,63 @@ def logout():
     return redirect('/login')
 
 
+def avatarCaching(response, immutable):
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = AVATAR_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
 @app.route('/avatar/<int:user_id>', methods=['GET'])
 def avatar(user_id):
+    version = request.args.get('v')
+    if version and version in request.if_none_match:
+        # versioned URLs never change content, no need to look anything up
+        response = Response(status=304)
+        response.set_etag(version)
+        return avatarCaching(response, True)
     user = UsersModel.query.filter_by(id=user_id).first()
-    avat = getAvat(user, user.av_type)
-    return send_file(avat)
+    if not user:
+        abort(404)
+    current = avatarVersion(user)
+    avat = getAvat(user, AVATAR_SIZES[-1])
+    if app.config['AVATAR_ACCEL_REDIRECT']:
+        response = Response(mimetype=guess_type(avat)[0])
+        response.headers['X-Accel-Redirect'] = \
+            app.config['AVATAR_ACCEL_REDIRECT'] + avat
+        response.set_etag(current)
+    else:
+        # answers If-None-Match and Range requests too
+        response = send_file(avat, etag=current, conditional=True)
+    return avatarCaching(response, version == current)
+
+
+@app.route('/static/dist/<path:filename>')
+def dist(filename):
+    # hashed names never change content; text assets come precompressed
+    directory = join(apath, DIST_DIR)
+    available = [kind for kind, suffix in ENCODINGS
+                 if isfile(join(directory, filename + suffix))]
+    kind = request.accept_encodings.best_match(available) \
+        if available else None
+    if kind:
+        response = send_from_directory(
+            directory, filename + dict(ENCODINGS)[kind],
+            mimetype=guess_type(filename)[0])
+        response.headers['Content-Encoding'] = kind
+    else:
+        response = send_from_directory(directory, filename)
+    if available:
+        response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.no_cache = None
+    response.cache_control.max_age = ASSET_MAX_AGE
+    response.cache_control.immutable = True
+    return response
 
 
 @app.route('/add_news', methods=['GET', 'POST'])
@@ -301,14 +905,25 @@ def add_news():
     if form.validate_on_submit():
         title = form.title.data
         content = form.content.data
-        time_ = ctime(time())
         new = NewsModel(title=title, content=content,
-                        user_id=session['user_id'], date=time_,
+                        user_id=session['user_id'], date=datetime.now(),
                         user_name=session['username'],
-                        fraction=session["logo"],
-                        bgpic=session["bgpic"])
+                        fraction=session.get("logo", DEFAULT_LOGO),
+                        bgpic=session.get("bgpic", DEFAULT_BGPIC))
         db.session.add(new)
+        db.session.flush()
+        # the author's feed has the post at once; fanOut does everyone
+        # else's after the commit
+        db.session.execute(insert(TimelineModel).from_select(
+            ['user_id', 'news_id', 'title'],
+            select(UsersModel.id, literal(new.id), literal(title)).where(
+                UsersModel.id == session['user_id'],
+                UsersModel.has_timeline)))
+        UsersModel.query.filter_by(id=session['user_id']).update(
+            {UsersModel.post_count: UsersModel.post_count + 1})
+        bumpCounter('news')
         db.session.commit()
+        timeline_pool.submit(fanOut, new.id, title, session['user_id'])
         return redirect(retpage)
     return render_template('add_news.html', title='Добавление новости',
                            form=form, username=session['username'])
@@ -324,10 +939,13 @@ def addtoguild(user_id):
     us_add = UsersModel.query.filter_by(id=user_id).first()
     if not us_add:
         return redirect('/wid0')
-    user = UsersModel.query.filter_by(id=session["user_id"]).first()
+    user = currentUser()
     if user.fraction == us_add.fraction:
-        user.coguild = dumps(list(set(loads(user.coguild) + [user_id])))
-        us_add.coguild = dumps(list(set(loads(us_add.coguild) + [user.id])))
+        # both edges in one statement, so racing requests can't lose one
+        db.session.execute(
+            insert(GuildModel).prefix_with('OR IGNORE').values([
+                {'user_id': user.id, 'member_id': user_id},
+                {'user_id': user_id, 'member_id': user.id}]))
         db.session.commit()
     return redirect(retpage)
 
@@ -339,18 +957,14 @@ def removefromguild(user_id):
     if user_id == 0 or user_id == session["user_id"]:
         return redirect('/wid0')
     retpage = request.args.get('from', '/index')
-    us_add = UsersModel.query.filter_by(id=user_id).first()
-    if not us_add:
+    if not UsersModel.query.filter_by(id=user_id).first():
         return redirect('/wid0')
-    user = UsersModel.query.filter_by(id=session["user_id"]).first()
-    us_cg = loads(user.coguild)
-    us_add_cd = loads(us_add.coguild)
-    if user_id in us_cg:
-        us_cg.remove(user_id)
-        us_add_cd.remove(user.id)
-        user.coguild = dumps(us_cg)
-        us_add.coguild = dumps(us_add_cd)
-        db.session.commit()
+    GuildModel.query.filter(or_(
+        and_(GuildModel.user_id == session["user_id"],
+             GuildModel.member_id == user_id),
+        and_(GuildModel.user_id == user_id,
+             GuildModel.member_id == session["user_id"]))).delete()
+    db.session.commit()
     return redirect(retpage)
 
 
@@ -361,14 +975,16 @@ def delete_news(news_id):
     retpage = request.args.get('from', '/index')
     new = NewsModel.query.filter_by(id=news_id).first()
     if new.user_id == session["user_id"] or session["username"] == 'admin':
-        users = UsersModel.query.filter(UsersModel.hdp is not None).all()
-        for user in users:
-            h = loads(user.hdp)
-            if news_id in h:
-                h.remove(news_id)
-            user.hdp = dumps(h)
+        dropCards(new)
+        # hidden_post_model and timeline_model rows go with it via
+        # ON DELETE CASCADE
         db.session.delete(new)
+        UsersModel.query.filter_by(id=new.user_id).update(
+            {UsersModel.post_count: UsersModel.post_count - 1})
+        bumpCounter('news')
         db.session.commit()
+        broker.publish({'type': 'delete', 'id': news_id,
+                        'user_id': new.user_id})
     return redirect(retpage)
 
 
@@ -377,15 +993,10 @@ def hide_news(news_id):
     if 'username' not in session:
         return redirect('/login')
     retpage = request.args.get('from', '/index')
-    user = UsersModel.query.filter_by(id=session["user_id"]).first()
-    logging.debug(user.user_name)
-    if user.hdp:
-        user.hdp = loads(user.hdp) + [news_id]
-    else:
-        user.hdp = [news_id]
-    user.hdp = dumps(list(set(user.hdp)))
-    logging.debug(user.hdp)
-    db.session.commit()
+    # written by writeHidden; feed reads overlay it until then
+    hidden_buffer.add(session["user_id"], news_id)
+    broker.publish({'type': 'hide', 'id': news_id,
+                    'user_id': session["user_id"]})
     return redirect(retpage)
 
 
@@ -393,34 +1004,79 @@ def hide_news(news_id):
 def hidden():
     if 'username' not in session:
         return redirect('/login')
-    news = getHiddenNews()
-    lenNews = len(news)
+    after = request.args.get('after', type=int)
+
+    def load():
+        news, next_page = getHiddenNews(after)
+        return (newsCard(n, 'hidden') for n in news), next_page
+
+    lenNews = HiddenPostModel.query.filter_by(
+        user_id=session["user_id"]).count()
+    pending = hidden_buffer.get(session["user_id"])
+    if pending:
+        lenNews += feedQuery(NewsModel).filter(
+            NewsModel.id.in_(pending),
+            NewsModel.id.notin_(hiddenIds(session["user_id"]))).count()
+    return stream_template(
+        'hidden.html', title='Спрятанные новости', lenNews=lenNews,
+        page=LazyPage(load))
+
+
+@app.route('/search')
+def search():
+    if 'username' not in session:
+        return redirect('/login')
+    q = request.args.get('q', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    news = []
+    next_page = None
+    query = ftsQuery(q)
+    if query:
+        pending = hidden_buffer.get(session["user_id"])
+        rows = feedSession().execute(text(NEWS_FTS_SEARCH), {
+            'query': query, 'user_id': session["user_id"],
+            'limit': NEWS_PAGE_SIZE + 1 + len(pending),
+            'offset': (page - 1) * NEWS_PAGE_SIZE})
+        ids = [row[0] for row in rows if row[0] not in pending]
+        if len(ids) > NEWS_PAGE_SIZE:
+            ids = ids[:NEWS_PAGE_SIZE]
+            next_page = page + 1
+        found = {n.id: n for n in feedQuery(NewsModel).filter(
+            NewsModel.id.in_(ids))}
+        news = [found[i] for i in ids if i in found]
     return render_template(
-        'hidden.html', title='Спрятанные новости',
-        news=news, lenNews=lenNews)
+        'search.html', title='Поиск', q=q, news=news,
+        cards=[newsCard(n, 'search') for n in news], next_page=next_page)
 
 
 @app.route('/wid<int:user_id>', methods=['GET'])
 def selfPage(user_id):
     if 'username' not in session:
         return redirect('/login')
-    user = UsersModel.query.filter_by(id=session["user_id"]).first()
-    if user_id == 0 and "user_id" in session:
+    user = currentUser()
+    if user_id in (0, user.id):
         user_s = user
     else:
         user_s = UsersModel.query.filter_by(id=user_id).first()
         if not user_s:
             return redirect('/index')
-    gld = loads(user.coguild)
-    guilded = (user_id in gld)
-    guildLen = len(gld)
+    gld = GuildModel.query.filter_by(user_id=user.id)
+    guilded = gld.filter_by(member_id=user_s.id).count() > 0
+    guildLen = gld.count()
     regdate = str(user_s.regdate).split('.')[0]
-    pic = getAvat(user_s, user_s.av_type)
-    news, nl = getNews(user_s.id)
-    return render_template(
+    pic = getAvat(user_s)
+    after = request.args.get('after', type=int)
+
+    def load():
+        news, nl, next_page = getNews(user_s.id, after)
+        return (newsCard(n, 'userpage', nl[n.id]) for n in news), next_page
+
+    newslen = visibleNews(user.id).filter_by(user_id=user_s.id).count()
+    return stream_template(
         "userpage.html",
         title="Страница пользователя " + user_s.user_name,
-        pic=pic, news=news, nl=nl, user=user_s, newslen=len(news),
+        pic=pic, avurl=avatarUrl(user_s),
+        page=LazyPage(load), user=user_s, newslen=newslen,
         regdate=regdate, add_allowed=(user_id == session["user_id"]),
         samefrac=(user.fraction == user_s.fraction), guilded=guilded,
         guildLen=guildLen)
@@ -433,20 +1089,20 @@ def settings():
     av_form = AvatarForm()
     us_form = ChangeUsernameForm()
     pass_form = ChangePasswordForm()
-    user = UsersModel.query.filter_by(id=session["user_id"]).first()
-    pic = getAvat(user, user.av_type)
+    user = currentUser()
+    pic = getAvat(user)
+    session["pic"] = getAvat(user, 50, still=True)
     if av_form.submit_av.data and av_form.validate_on_submit():
         f = av_form.avatar.data
-        user = UsersModel.query.filter_by(id=session["user_id"]).first()
         if f.filename.split('.')[-1] == 'gif':
-            fnm = 'static/img/' + str(session["user_id"]) + "_av.gif"
-            user.av_type = 'gif'
+            ext = 'gif'
         else:
-            fnm = 'static/img/' + str(session["user_id"]) + "_av.png"
-            user.av_type = 'png'
-        f.save(join(apath, fnm))
-        db.session.commit()
-        session["pic"] = getAvat(user, user.av_type)
+            ext = 'png'
+        fd, tmp = mkstemp(suffix='.upload',
+                          dir=app.config['UPLOAD_SPOOL_DIR'])
+        close(fd)
+        f.save(tmp)
+        avatar_pool.submit(saveAvatar, session["user_id"], tmp, ext)
         return redirect('/settings')
     if us_form.submit_us.data and us_form.validate_on_submit():
         user.user_name = us_form.new_name.data
@@ -454,7 +1110,7 @@ def settings():
         db.session.commit()
         return redirect('/settings')
     if pass_form.submit_pass.data and pass_form.validate_on_submit():
-        user.password_hash = generate_password_hash(pass_form.password.data)
+        user.password_hash = credentials.hash(pass_form.password.data)
         db.session.commit()
         return redirect('/settings')
     return render_template('settings.html', title='Настройки', av_form=av_form,
@@ -465,20 +1121,54 @@ def settings():
 def show_news(news_id):
     if 'username' not in session:
         return redirect('/login')
-    user = UsersModel.query.filter_by(id=session["user_id"]).first()
-    if user.hdp:
-        try:
-            user.hdp = loads(user.hdp)
-            user.hdp.remove(news_id)
-        except Exception:
-            pass
-    else:
-        user.hdp = []
-    user.hdp = dumps(list(set(user.hdp)))
-    db.session.commit()
+    # an unflushed hide is simply dropped; otherwise a running flush
+    # must land first
+    shown = hidden_buffer.discard(session["user_id"], news_id)
+    if not shown:
+        hidden_buffer.settle()
+        shown = HiddenPostModel.query.filter_by(
+            user_id=session["user_id"], news_id=news_id).delete()
+        if shown:
+            bumpFeed(session["user_id"])
+            viewer = currentUser()
+            # news below the floor are read from news_model anyway
+            if viewer.has_timeline and news_id >= viewer.timeline_floor:
+                db.session.execute(
+                    insert(TimelineModel).prefix_with(
+                        'OR IGNORE').from_select(
+                        ['user_id', 'news_id', 'title'],
+                        select(literal(session["user_id"]), NewsModel.id,
+                               NewsModel.title).where(
+                            NewsModel.id == news_id)))
+        db.session.commit()
+    if shown:
+        broker.publish({'type': 'show', 'id': news_id,
+                        'user_id': session["user_id"]})
     return redirect('/hidden')
 
 
+@app.route('/events')
+def events():
+    # one Server-Sent Events stream per open feed page
+    if 'username' not in session:
+        return Response(status=401)
+    subscriber = event_hub.subscribe(session["user_id"], [
+        row[0] for row in feedSession().execute(
+            hiddenIds(session["user_id"]))] + list(
+        hidden_buffer.get(session["user_id"])))
+    if subscriber is None:
+        return Response(status=503, headers={'Retry-After': '60'})
+    keepalive = app.config['EVENTS_KEEPALIVE']
+    # asgi.py awaits this instead of iterating the body in a thread
+    request.environ['vw.events'] = subscriber.astream(keepalive)
+    response = Response(subscriber.stream(keepalive),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'})
+    response.call_on_close(lambda: event_hub.unsubscribe(subscriber))
+    return response
+
+
 @app.route('/sitemap', methods=['GET'])
 def sitemap():
     if 'username' not in session:
@@ -514,58 +1204,265 @@ def terms():
 def user_list():
     if 'username' not in session:
         return redirect('/login')
-    data = list(map(lambda x: [x.user_name, x.id, x.fraction, str(len(
-        NewsModel.query.filter_by(user_id=x.id).all()))],
-        UsersModel.query.all()))
+    after = request.args.get('after', 0, type=int)
+    data = UsersModel.query.with_entities(
+        UsersModel.user_name, UsersModel.id, UsersModel.fraction,
+        UsersModel.post_count).filter(UsersModel.id > after).order_by(
+        UsersModel.id).limit(USERS_PAGE_SIZE + 1).all()
+    next_page = None
+    if len(data) > USERS_PAGE_SIZE:
+        data = data[:USERS_PAGE_SIZE]
+        next_page = data[-1].id
     return render_template(
-        'user_list.html', title='Информация о пользователях', data=data)
+        'user_list.html', title='Информация о пользователях', data=data,
+        next_page=next_page)
+
+
+def guildQuery(user_id):
+    # the user's guild members with their own guild sizes
+    members = GuildModel.__table__.alias()
+    guild_size = select(func.count()).select_from(members).where(
+        members.c.user_id == UsersModel.id).correlate(
+        UsersModel).scalar_subquery()
+    return db.session.query(
+        UsersModel.user_name, UsersModel.id, guild_size,
+        UsersModel.post_count).join(
+        GuildModel, GuildModel.member_id == UsersModel.id).filter(
+        GuildModel.user_id == user_id)
 
 
 @app.route('/guild')
 def guild():
     if 'username' not in session:
         return redirect('/login')
-    cgls = loads(UsersModel.query.filter_by(
-        id=session["user_id"]).first().coguild)
-    cglslist = []
-    nl = {}
-    for idd in cgls:
-        us = UsersModel.query.filter_by(id=idd).first()
-        cglslist.append(us)
-        nl[us] = str(len(NewsModel.query.filter_by(user_id=idd).all()))
-    data = list(map(lambda x: [x.user_name, x.id, str(len(loads(x.coguild))),
-                               nl[x]],
-                    cglslist))
+    data = guildQuery(session["user_id"]).all()
     return render_template(
         'user_list.html', title='Информация о пользователях', data=data)
 
 
+# JSON API, /api/v1: cursor-paginated (?after=<last id>&limit=N) with
+# ?fields=a,b to pick fields; feed pages carry an ETag built from the news
+# counter and the viewer's feed_version, so unchanged pages cost a 304
+NEWS_FIELDS = ('id', 'title', 'content', 'user_id', 'user_name', 'date',
+               'fraction', 'bgpic')
+USER_FIELDS = ('id', 'user_name', 'fraction', 'regdate', 'post_count',
+               'guild_size', 'avatar')
+
+
+def apiError(status, message):
+    return make_response(jsonify(error=message), status)
+
+
+def apiFields(allowed):
+    fields = request.args.get('fields')
+    if not fields:
+        return allowed
+    fields = fields.split(',')
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        abort(apiError(400, 'unknown fields: ' + ', '.join(unknown)))
+    return fields
+
+
+def apiLimit(default):
+    return min(max(request.args.get('limit', default, type=int), 1),
+               API_PAGE_SIZE)
+
+
+def apiValue(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def apiPage(items, fields, next_page, row):
+    # the page plus the URL of the next one, None on the last page
+    next_url = None
+    if next_page is not None:
+        args = request.args.to_dict()
+        args['after'] = next_page
+        next_url = url_for(request.endpoint, **dict(request.view_args,
+                                                    **args))
+    return jsonify({'items': [row(item, fields) for item in items],
+                    'next': next_url})
+
+
+def newsRow(item, fields):
+    return {field: apiValue(getattr(item, field)) for field in fields}
+
+
+def userRow(item, fields):
+    user, guild_size = item
+    row = {}
+    for field in fields:
+        if field == 'guild_size':
+            row[field] = guild_size
+        elif field == 'avatar':
+            row[field] = avatarUrl(user)
+        else:
+            row[field] = apiValue(getattr(user, field))
+    return row
+
+
+def usersQuery():
+    # users with their guild size, as (UsersModel, guild_size) rows
+    members = GuildModel.__table__.alias()
+    guild_size = select(func.count()).select_from(members).where(
+        members.c.user_id == UsersModel.id).correlate(
+        UsersModel).scalar_subquery()
+    return db.session.query(UsersModel, guild_size).options(
+        defer(UsersModel.password_hash))
+
+
+def feedEtag(viewer, params):
+    news = db.session.query(CounterModel.value).filter_by(
+        name='news').scalar() or 0
+    digest = sha1(repr(params).encode()).hexdigest()[:12]
+    return '%d.%d.%s.%s' % (news, viewer.feed_version,
+                            hidden_buffer.version(viewer.id), digest)
+
+
+def conditional(response):
+    # ETag from the body for responses without a cheaper version
+    response.add_etag()
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@app.route('/api/v1/news')
+def api_news():
+    if 'username' not in session:
+        return apiError(401, 'login required')
+    fields = apiFields(NEWS_FIELDS)
+    size = apiLimit(NEWS_PAGE_SIZE)
+    after = request.args.get('after', type=int)
+    author = request.args.get('user', type=int)
+    order = {}
+    if 'sort' in request.args:
+        order['by_id'] = request.args['sort'] == 'id'
+    if 'order' in request.args:
+        order['reverse'] = request.args['order'] == 'desc'
+    viewer = currentUser()
+    etag = feedEtag(viewer, (fields, size, after, author, sorted(
+        order.items()), session.get('news_sort_type'),
+        session.get('reverse')))
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        if author:
+            news, next_page = getPage(visibleNews(viewer.id).filter_by(
+                user_id=author), after, size, **order)
+        else:
+            news, next_page = getFeed(after, size, **order)
+        response = apiPage(news, fields, next_page, newsRow)
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/api/v1/users/<int:user_id>')
+def api_user(user_id):
+    if 'username' not in session:
+        return apiError(401, 'login required')
+    fields = apiFields(USER_FIELDS)
+    user = usersQuery().filter(UsersModel.id == user_id).first()
+    if not user:
+        return apiError(404, 'no such user')
+    return conditional(jsonify(userRow(user, fields)))
+
+
+@app.route('/api/v1/guild')
+def api_guild():
+    if 'username' not in session:
+        return apiError(401, 'login required')
+    fields = apiFields(USER_FIELDS)
+    size = apiLimit(USERS_PAGE_SIZE)
+    data = usersQuery().join(
+        GuildModel, GuildModel.member_id == UsersModel.id).filter(
+        GuildModel.user_id == session["user_id"],
+        UsersModel.id > request.args.get('after', 0, type=int)).order_by(
+        UsersModel.id).limit(size + 1).all()
+    next_page = None
+    if len(data) > size:
+        data = data[:size]
+        next_page = data[-1][0].id
+    return conditional(apiPage(data, fields, next_page, userRow))
+
+
 @app.errorhandler(404)
 def e404(e):
     return render_template('404.html'), 404
 
 
+@app.errorhandler(CredentialsBusy)
+def credentialsBusy(e):
+    return Response('Сервер перегружен, попробуйте позже', 503,
+                    {'Retry-After': '5'}, mimetype='text/plain')
+
+
+def planQueries(user_id=1, after=100, title='a'):
+    # {name: SQL} of the hot reads, built by the same functions as the
+    # views, with values inlined; migrate.py check-plans explains them
+    last = NewsModel(id=after, title=title)
+    page = {'after': after, 'last': last}
+    queries = {
+        'feed by id': pageQuery(visibleNews(user_id), by_id=True,
+                                reverse=False, **page),
+        'feed by title': pageQuery(visibleNews(user_id), by_id=False,
+                                   reverse=False, **page),
+        'timeline by id': pageQuery(timelineNews(user_id), by_id=True,
+                                    reverse=True, **page, **TIMELINE_ORDER),
+        'timeline by title': pageQuery(timelineNews(user_id), by_id=False,
+                                       reverse=False, **page,
+                                       **TIMELINE_ORDER),
+        'profile': pageQuery(visibleNews(user_id).filter_by(user_id=user_id),
+                             by_id=True, reverse=True),
+        'profile post count': visibleNews(user_id).filter_by(
+            user_id=user_id).statement.with_only_columns(func.count()),
+        'hidden posts': pageQuery(hiddenNews(user_id), by_id=True,
+                                  reverse=False),
+        'search': text(NEWS_FTS_SEARCH).bindparams(
+            query=ftsQuery(title), user_id=user_id,
+            limit=NEWS_PAGE_SIZE + 1, offset=0),
+        'guild': guildQuery(user_id),
+    }
+    return {name: str(getattr(query, 'statement', query).compile(
+        dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+        for name, query in queries.items()}
+
+
 def makeDefUsers(rest=False):
+    # brings an existing database up to date with migrate.py, creates a new
+    # one at the latest migration and, on an empty database, the default
+    # users; rest=True wipes everything first
     if rest:
         db.drop_all()
+    path = db.engine.url.database
+    if inspect(db.engine).has_table('users_model'):
+        if path and path != ':memory:':
+            migrate(path)
+        db.create_all()
+    else:
         db.create_all()
+        db.session.execute(text('PRAGMA user_version = %d' % len(MIGRATIONS)))
+        db.session.commit()
+    if UsersModel.query.first() is None:
         user = UsersModel(
             user_name='admin',
-            password_hash=generate_password_hash('admin'),
+            password_hash=credentials.hash('admin'),
             fraction='Альянс',
             regdate=datetime.now())
         user2 = UsersModel(
             user_name='qwe',
-            password_hash=generate_password_hash('rty'),
+            password_hash=credentials.hash('rty'),
             fraction='Орда',
             regdate=datetime.now())
         db.session.add(user)
         db.session.add(user2)
         db.session.commit()
-    else:
-        db.create_all()
 
 
 if __name__ == '__main__':
-    makeDefUsers(True)
+    with app.app_context():
+        makeDefUsers()
     app.run(port=8000, host='127.0.0.1')
@@ -0,0 +1,191 @@
+"""Per-route request profiling.
+
+When METRICS_ENABLED is set, every request records its SQL query count, the
+time spent in SQLAlchemy, the time spent rendering templates and its total
+latency, aggregated per endpoint. /metrics shows the totals in the
+Prometheus text format and METRICS_SERVER_TIMING adds a Server-Timing
+header to each response.
+
+Streamed pages run most of their queries and template code while the body
+is sent, so their sample is recorded when the response is closed. Headers
+go out before that: with METRICS_SERVER_TIMING a streamed body is collected
+first, so the header covers it.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Lock
+from time import perf_counter
+
+from flask import (Response, abort, before_render_template, g,
+                   has_request_context, request, template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class RouteStats:
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+
+class Metrics:
+    def __init__(self):
+        self.routes = defaultdict(RouteStats)
+        # name -> [count, sum] for timings recorded outside of requests
+        self.timings = defaultdict(lambda: [0, 0.0])
+        self.lock = Lock()
+
+    def record(self, endpoint, sample):
+        with self.lock:
+            stats = self.routes[endpoint]
+            stats.requests += 1
+            stats.queries += sample['queries']
+            stats.db_seconds += sample['db']
+            stats.template_seconds += sample['templates']
+            stats.seconds += sample['total']
+            stats.buckets[bisect_left(LATENCY_BUCKETS, sample['total'])] += 1
+
+    def observe(self, name, seconds):
+        with self.lock:
+            timing = self.timings[name]
+            timing[0] += 1
+            timing[1] += seconds
+
+    def render(self):
+        lines = []
+
+        def family(name, kind, text):
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        with self.lock:
+            routes = sorted(self.routes.items())
+            counters = [
+                ('vw_requests_total', 'requests', 'Requests served.'),
+                ('vw_db_queries_total', 'queries', 'SQL statements run.'),
+                ('vw_db_seconds_total', 'db_seconds',
+                 'Time spent executing SQL.'),
+                ('vw_template_seconds_total', 'template_seconds',
+                 'Time spent rendering templates.'),
+            ]
+            for name, attr, text in counters:
+                family(name, 'counter', text)
+                for endpoint, stats in routes:
+                    lines.append('%s{endpoint="%s"} %s' % (
+                        name, endpoint, getattr(stats, attr)))
+            family('vw_request_seconds', 'histogram', 'Request latency.')
+            for endpoint, stats in routes:
+                total = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',),
+                                        stats.buckets):
+                    total += count
+                    lines.append('vw_request_seconds_bucket'
+                                 '{endpoint="%s",le="%s"} %d' % (
+                                     endpoint, bound, total))
+                lines.append('vw_request_seconds_sum{endpoint="%s"} %s' % (
+                    endpoint, stats.seconds))
+                lines.append('vw_request_seconds_count{endpoint="%s"} %d' % (
+                    endpoint, stats.requests))
+            for name, (count, seconds) in sorted(self.timings.items()):
+                family('vw_%s_seconds' % name, 'summary', name + ' timing.')
+                lines.append('vw_%s_seconds_sum %s' % (name, seconds))
+                lines.append('vw_%s_seconds_count %d' % (name, count))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def sample():
+    # the running request's sample, None when not profiling
+    if has_request_context():
+        return g.get('metrics_sample')
+    return None
+
+
+def beforeQuery(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_start', []).append(perf_counter())
+
+
+def afterQuery(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['metrics_start'].pop()
+    current = sample()
+    if current is not None:
+        current['queries'] += 1
+        current['db'] += perf_counter() - start
+
+
+def queryFailed(context):
+    if context.connection is not None:
+        starts = context.connection.info.get('metrics_start')
+        if starts:
+            starts.pop()
+
+
+def beforeTemplate(app, template, context):
+    current = sample()
+    if current is not None:
+        current['template_start'] = perf_counter()
+
+
+def afterTemplate(app, template, context):
+    current = sample()
+    if current is not None and 'template_start' in current:
+        current['templates'] += perf_counter() - \
+            current.pop('template_start')
+
+
+def initMetrics(app):
+    app.config.setdefault('METRICS_ENABLED', False)
+    app.config.setdefault('METRICS_SERVER_TIMING', False)
+    event.listen(Engine, 'before_cursor_execute', beforeQuery)
+    event.listen(Engine, 'after_cursor_execute', afterQuery)
+    event.listen(Engine, 'handle_error', queryFailed)
+    before_render_template.connect(beforeTemplate, app)
+    template_rendered.connect(afterTemplate, app)
+
+    @app.before_request
+    def startSample():
+        if app.config['METRICS_ENABLED']:
+            g.metrics_sample = {'start': perf_counter(), 'queries': 0,
+                                'db': 0.0, 'templates': 0.0}
+
+    def finish(endpoint, current):
+        current['total'] = perf_counter() - current['start']
+        metrics.record(endpoint, current)
+
+    @app.after_request
+    def recordSample(response):
+        current = sample()
+        if current is None:
+            return response
+        endpoint = request.endpoint or 'none'
+        if response.is_streamed:
+            # an event stream never ends, so it is never collected
+            if not app.config['METRICS_SERVER_TIMING'] or \
+               response.mimetype == 'text/event-stream':
+                response.call_on_close(lambda: finish(endpoint, current))
+                return response
+            response.make_sequence()
+        finish(endpoint, current)
+        if app.config['METRICS_SERVER_TIMING']:
+            response.headers['Server-Timing'] = (
+                'db;dur=%.2f;desc="%d queries", tpl;dur=%.2f, '
+                'total;dur=%.2f' % (
+                    current['db'] * 1000, current['queries'],
+                    current['templates'] * 1000, current['total'] * 1000))
+        return response
+
+    @app.route('/metrics')
+    def metricsPage():
+        if not app.config['METRICS_ENABLED']:
+            abort(404)
+        return Response(metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,471 @@
+"""Schema migrations and maintenance commands for an existing database.
+
+Usage: python migrate.py [--db path/to/vwb.db] [command]
+
+The default command, migrate, runs every step of MIGRATIONS once, each in
+its own transaction; the number of applied steps is kept in
+PRAGMA user_version.
+"""
+from json import loads
+from os import environ, makedirs
+from os.path import join, exists, abspath, dirname
+from argparse import ArgumentParser
+from datetime import datetime
+import sqlite3
+
+from avatars import AVATAR_DIR, processAvatar
+from search import NEWS_FTS_DDL, NEWS_FTS_REBUILD
+
+
+CHUNK_SIZE = 10000
+# statistics taken from fewer news than this would keep the planner on
+# table scans once the database has grown, so it goes without until then
+ANALYZE_MIN_NEWS = 1000
+apath = dirname(abspath(__file__))
+# a timeline holds its user's newest TIMELINE_SIZE visible news and is
+# trimmed back to that every TIMELINE_TRIM_EVERY news; users_model.
+# timeline_floor is the lowest news id from which it is complete, 0 when it
+# holds everything
+TIMELINE_SIZE = 1000
+TIMELINE_TRIM_EVERY = 100
+# the statements below take the user id range :lo - :hi
+TIMELINE_BUILT = '''
+    UPDATE users_model SET has_timeline = 1, timeline_floor = CASE
+        WHEN (SELECT count(*) FROM timeline_model
+              WHERE timeline_model.user_id = users_model.id) >= :size
+        THEN (SELECT min(news_id) FROM timeline_model
+              WHERE timeline_model.user_id = users_model.id)
+        ELSE 0 END
+    WHERE id BETWEEN :lo AND :hi'''
+TIMELINE_FLOOR = '''
+    UPDATE users_model SET timeline_floor = max(timeline_floor, coalesce((
+        SELECT news_id + 1 FROM timeline_model
+        WHERE timeline_model.user_id = users_model.id
+        ORDER BY news_id DESC LIMIT 1 OFFSET :size), 0))
+    WHERE has_timeline AND id BETWEEN :lo AND :hi'''
+TIMELINE_TRIM = '''
+    DELETE FROM timeline_model WHERE user_id BETWEEN :lo AND :hi
+    AND news_id < (SELECT timeline_floor FROM users_model
+                   WHERE users_model.id = timeline_model.user_id)'''
+
+
+def chunks(rows, size=CHUNK_SIZE):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def columns(con, table):
+    return [row[1] for row in con.execute('PRAGMA table_info(%s)' % table)]
+
+
+def hiddenPosts(con):
+    # users_model.hdp (JSON list) -> hidden_post_model rows
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS hidden_post_model (
+            user_id INTEGER NOT NULL,
+            news_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, news_id),
+            FOREIGN KEY(user_id) REFERENCES users_model (id)
+                ON DELETE CASCADE,
+            FOREIGN KEY(news_id) REFERENCES news_model (id)
+                ON DELETE CASCADE
+        )''')
+    con.execute('CREATE INDEX IF NOT EXISTS ix_hidden_post_model_news_id '
+                'ON hidden_post_model (news_id)')
+    if 'hdp' not in columns(con, 'users_model'):
+        return
+
+    def pairs():
+        for user_id, hdp in con.execute(
+                'SELECT id, hdp FROM users_model WHERE hdp IS NOT NULL'):
+            for news_id in set(loads(hdp)):
+                yield user_id, int(news_id)
+
+    # ids of news deleted in the meantime are dropped by the join
+    for chunk in chunks(pairs()):
+        con.executemany('INSERT OR IGNORE INTO hidden_post_model '
+                        'SELECT ?, id FROM news_model WHERE id = ?', chunk)
+    con.execute('ALTER TABLE users_model DROP COLUMN hdp')
+
+
+def guildEdges(con):
+    # users_model.coguild (JSON list) -> guild_model edges, both directions
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS guild_model (
+            user_id INTEGER NOT NULL,
+            member_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, member_id),
+            FOREIGN KEY(user_id) REFERENCES users_model (id)
+                ON DELETE CASCADE,
+            FOREIGN KEY(member_id) REFERENCES users_model (id)
+                ON DELETE CASCADE
+        )''')
+    con.execute('CREATE INDEX IF NOT EXISTS ix_guild_model_member_id '
+                'ON guild_model (member_id)')
+    if 'coguild' not in columns(con, 'users_model'):
+        return
+
+    def edges():
+        for user_id, coguild in con.execute(
+                'SELECT id, coguild FROM users_model '
+                'WHERE coguild IS NOT NULL'):
+            for member_id in set(loads(coguild)):
+                yield user_id, int(member_id), user_id
+                yield int(member_id), user_id, int(member_id)
+
+    for chunk in chunks(edges()):
+        con.executemany('INSERT OR IGNORE INTO guild_model '
+                        'SELECT ?, id FROM users_model WHERE id = ? '
+                        'AND EXISTS (SELECT 1 FROM users_model '
+                        'WHERE id = ?)', chunk)
+    con.execute('ALTER TABLE users_model DROP COLUMN coguild')
+
+
+def postCount(con):
+    # denormalized users_model.post_count, filled from one GROUP BY
+    if 'post_count' in columns(con, 'users_model'):
+        return
+    con.execute('ALTER TABLE users_model '
+                'ADD COLUMN post_count INTEGER NOT NULL DEFAULT 0')
+    recountPosts(con)
+
+
+def recountPosts(con):
+    con.execute('''
+        UPDATE users_model SET post_count = coalesce((
+            SELECT count(*) FROM news_model
+            WHERE news_model.user_id = users_model.id), 0)''')
+
+
+def avatarPath(con):
+    # users_model.av_path, resolved once from the files on disk
+    if 'av_path' in columns(con, 'users_model'):
+        return
+    con.execute('ALTER TABLE users_model ADD COLUMN av_path VARCHAR(100)')
+    found = []
+    for user_id, av_type in con.execute(
+            'SELECT id, av_type FROM users_model'):
+        fnm = 'static/img/%d_av.%s' % (user_id, av_type)
+        if exists(join(apath, fnm)):
+            found.append((fnm, user_id))
+    for chunk in chunks(found):
+        con.executemany('UPDATE users_model SET av_path = ? WHERE id = ?',
+                        chunk)
+
+
+def avatarVariants(con):
+    # single-file avatars -> content-addressed thumbnails in AVATAR_DIR
+    makedirs(join(apath, AVATAR_DIR), exist_ok=True)
+    done = []
+    for user_id, av_path, av_type in con.execute(
+            'SELECT id, av_path, av_type FROM users_model '
+            'WHERE av_path IS NOT NULL'):
+        if av_path.startswith(AVATAR_DIR) or \
+           not exists(join(apath, av_path)):
+            continue
+        name, av_type = processAvatar(join(apath, av_path),
+                                      join(apath, AVATAR_DIR), av_type)
+        done.append((join(AVATAR_DIR, name), av_type, user_id))
+    con.executemany('UPDATE users_model SET av_path = ?, av_type = ? '
+                    'WHERE id = ?', done)
+
+
+def newsSearch(con):
+    # FTS5 index over news_model, filled from the existing rows
+    for ddl in NEWS_FTS_DDL:
+        con.execute(ddl)
+    rebuildSearch(con)
+
+
+def rebuildSearch(con):
+    con.execute(NEWS_FTS_REBUILD)
+
+
+def rebuildTimeline(con):
+    # every user's timeline: the newest news_model rows minus their hidden
+    # posts, one user at a time
+    con.execute('DELETE FROM timeline_model')
+    users = [row[0] for row in con.execute('SELECT id FROM users_model')]
+    for user_id in users:
+        con.execute('''
+            INSERT INTO timeline_model (user_id, news_id, title)
+            SELECT ?, id, title FROM news_model
+            WHERE id NOT IN (SELECT news_id FROM hidden_post_model
+                             WHERE user_id = ?)
+            ORDER BY id DESC LIMIT ?''', (user_id, user_id, TIMELINE_SIZE))
+    con.execute(TIMELINE_BUILT, {'lo': 0, 'hi': users[-1] if users else 0,
+                                 'size': TIMELINE_SIZE})
+
+
+def verifyTimeline(con):
+    # built timelines must hold exactly the news their owner has not hidden
+    # from their floor up, and no more than a trim's worth past their size
+    missing = con.execute('''
+        SELECT count(*) FROM users_model, news_model
+        WHERE users_model.has_timeline
+        AND news_model.id >= users_model.timeline_floor AND NOT EXISTS (
+            SELECT 1 FROM hidden_post_model
+            WHERE hidden_post_model.user_id = users_model.id
+            AND hidden_post_model.news_id = news_model.id)
+        AND NOT EXISTS (
+            SELECT 1 FROM timeline_model
+            WHERE timeline_model.user_id = users_model.id
+            AND timeline_model.news_id = news_model.id)''').fetchone()[0]
+    extra = con.execute('''
+        SELECT count(*) FROM timeline_model
+        JOIN users_model ON users_model.id = timeline_model.user_id
+        LEFT JOIN news_model ON news_model.id = timeline_model.news_id
+        WHERE NOT users_model.has_timeline OR news_model.id IS NULL
+        OR news_model.title != timeline_model.title
+        OR timeline_model.news_id < users_model.timeline_floor OR EXISTS (
+            SELECT 1 FROM hidden_post_model
+            WHERE hidden_post_model.user_id = timeline_model.user_id
+            AND hidden_post_model.news_id = timeline_model.news_id)
+        ''').fetchone()[0]
+    oversized = con.execute('''
+        SELECT count(*) FROM (SELECT user_id FROM timeline_model
+                              GROUP BY user_id HAVING count(*) > ?)''', (
+        TIMELINE_SIZE + TIMELINE_TRIM_EVERY,)).fetchone()[0]
+    users = con.execute('SELECT count(*) FROM users_model '
+                        'WHERE has_timeline').fetchone()[0]
+    print('timelines %d, missing rows %d, stale rows %d, oversized %d' % (
+        users, missing, extra, oversized))
+    if missing or extra or oversized:
+        raise SystemExit('timelines out of step, run rebuild-timeline')
+
+
+def ctimeToDatetime(value):
+    try:
+        return str(datetime.strptime(value, '%a %b %d %H:%M:%S %Y'))
+    except (TypeError, ValueError):
+        return value
+
+
+def newsSchema(con):
+    # news_model.date ctime() string -> DATETIME, user_id foreign key,
+    # indexes on (user_id, id), title and date; SQLite can't alter a
+    # column, so the table is rebuilt
+    con.create_function('ctime_to_datetime', 1, ctimeToDatetime)
+    con.execute('''
+        CREATE TABLE news_model_new (
+            id INTEGER NOT NULL,
+            title VARCHAR(100) NOT NULL,
+            content VARCHAR(1000) NOT NULL,
+            user_id INTEGER NOT NULL,
+            user_name VARCHAR(50) NOT NULL,
+            date DATETIME NOT NULL,
+            fraction VARCHAR(1) NOT NULL,
+            bgpic VARCHAR(15) NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(user_id) REFERENCES users_model (id)
+                ON DELETE CASCADE
+        )''')
+    con.execute('''
+        INSERT INTO news_model_new
+        SELECT id, title, content, user_id, user_name,
+               ctime_to_datetime(date), fraction, bgpic
+        FROM news_model''')
+    con.execute('DROP TABLE news_model')
+    con.execute('ALTER TABLE news_model_new RENAME TO news_model')
+    con.execute('CREATE INDEX ix_news_model_user_id_id '
+                'ON news_model (user_id, id)')
+    con.execute('CREATE INDEX ix_news_model_title ON news_model (title)')
+    con.execute('CREATE INDEX ix_news_model_date ON news_model (date)')
+    # the search triggers went with the old table
+    for ddl in NEWS_FTS_DDL[1:]:
+        con.execute(ddl)
+
+
+def timelines(con):
+    # timeline_model and users_model.has_timeline; timelines are built at
+    # login, or all at once by rebuild-timeline
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS timeline_model (
+            user_id INTEGER NOT NULL,
+            news_id INTEGER NOT NULL,
+            title VARCHAR(100) NOT NULL,
+            PRIMARY KEY (user_id, news_id),
+            FOREIGN KEY(user_id) REFERENCES users_model (id)
+                ON DELETE CASCADE,
+            FOREIGN KEY(news_id) REFERENCES news_model (id)
+                ON DELETE CASCADE
+        )''')
+    con.execute('CREATE INDEX IF NOT EXISTS ix_timeline_model_news_id '
+                'ON timeline_model (news_id)')
+    con.execute('CREATE INDEX IF NOT EXISTS '
+                'ix_timeline_model_user_id_title_news_id '
+                'ON timeline_model (user_id, title, news_id)')
+    if 'has_timeline' not in columns(con, 'users_model'):
+        con.execute('ALTER TABLE users_model '
+                    'ADD COLUMN has_timeline BOOLEAN NOT NULL DEFAULT 0')
+
+
+def feedVersions(con):
+    # ETag inputs of the JSON API: per-user feed_version, news counter
+    if 'feed_version' not in columns(con, 'users_model'):
+        con.execute('ALTER TABLE users_model '
+                    'ADD COLUMN feed_version INTEGER NOT NULL DEFAULT 0')
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS counter_model (
+            name VARCHAR(20) NOT NULL,
+            value INTEGER NOT NULL,
+            PRIMARY KEY (name)
+        )''')
+
+
+def passwordHashes(con):
+    # users_model.password_hash VARCHAR(128) -> VARCHAR(255), scrypt hashes
+    # are longer; rebuilt like news_model in newsSchema
+    names = ('id, user_name, password_hash, fraction, regdate, av_type, '
+             'av_path, post_count, has_timeline, feed_version')
+    con.execute('''
+        CREATE TABLE users_model_new (
+            id INTEGER NOT NULL,
+            user_name VARCHAR(50) NOT NULL,
+            password_hash VARCHAR(255) NOT NULL,
+            fraction VARCHAR(6) NOT NULL,
+            regdate DATETIME NOT NULL,
+            av_type VARCHAR(4) NOT NULL,
+            av_path VARCHAR(100),
+            post_count INTEGER NOT NULL DEFAULT 0,
+            has_timeline BOOLEAN NOT NULL DEFAULT 0,
+            feed_version INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (id),
+            UNIQUE (user_name)
+        )''')
+    con.execute('INSERT INTO users_model_new (%s) SELECT %s FROM users_model'
+                % (names, names))
+    con.execute('DROP TABLE users_model')
+    con.execute('ALTER TABLE users_model_new RENAME TO users_model')
+
+
+def timelineFloors(con):
+    # users_model.timeline_floor; existing timelines are complete (0) and
+    # are cut down to TIMELINE_SIZE here
+    if 'timeline_floor' not in columns(con, 'users_model'):
+        con.execute('ALTER TABLE users_model '
+                    'ADD COLUMN timeline_floor INTEGER NOT NULL DEFAULT 0')
+    params = {'lo': 0, 'size': TIMELINE_SIZE, 'hi': con.execute(
+        'SELECT coalesce(max(id), 0) FROM users_model').fetchone()[0]}
+    con.execute(TIMELINE_FLOOR, params)
+    con.execute(TIMELINE_TRIM, params)
+
+
+MIGRATIONS = [hiddenPosts, guildEdges, postCount, avatarPath,
+              avatarVariants, newsSearch, newsSchema, timelines,
+              feedVersions, passwordHashes, timelineFloors]
+
+
+def analyze(con):
+    # planner statistics for the finished schema, after the last migration
+    news = con.execute('SELECT count(*) FROM news_model').fetchone()[0]
+    if news >= ANALYZE_MIN_NEWS:
+        con.execute('ANALYZE')
+    elif con.execute("SELECT 1 FROM sqlite_master "
+                     "WHERE name = 'sqlite_stat1'").fetchone():
+        con.execute('DELETE FROM sqlite_stat1')
+        con.execute('ANALYZE sqlite_master')
+
+
+def migrate(path):
+    con = sqlite3.connect(path, isolation_level=None)
+    version = con.execute('PRAGMA user_version').fetchone()[0]
+    for number, step in enumerate(MIGRATIONS[version:], version + 1):
+        con.execute('BEGIN')
+        try:
+            step(con)
+            con.execute('PRAGMA user_version = %d' % number)
+            con.execute('COMMIT')
+        except Exception:
+            con.execute('ROLLBACK')
+            raise
+        print('applied', number, step.__name__)
+    if version < len(MIGRATIONS):
+        analyze(con)
+    con.close()
+
+
+def run(path, step):
+    con = sqlite3.connect(path, isolation_level=None)
+    con.execute('BEGIN')
+    try:
+        step(con)
+        con.execute('COMMIT')
+    except Exception:
+        con.execute('ROLLBACK')
+        raise
+    con.close()
+
+
+# hot queries, as built by main.planQueries, and what their plans must not
+# fall back to
+PLAN_CHECKS = [
+    ('feed by id', ['TEMP B-TREE', 'SCAN hidden']),
+    ('feed by title', ['TEMP B-TREE', 'SCAN news_model ', 'SCAN hidden']),
+    ('timeline by id', ['TEMP B-TREE', 'SCAN']),
+    ('timeline by title', ['TEMP B-TREE', 'SCAN']),
+    ('profile', ['TEMP B-TREE', 'SCAN news_model', 'SCAN hidden']),
+    ('profile post count', ['SCAN news_model', 'SCAN hidden']),
+    ('hidden posts', ['TEMP B-TREE', 'SCAN news_model', 'SCAN hidden']),
+    ('search', ['SCAN hidden']),
+    ('guild', ['SCAN guild', 'SCAN users']),
+]
+
+
+def planQueries(con):
+    # the app's own statements, built against this database file
+    path = con.execute('PRAGMA database_list').fetchone()[2]
+    environ['VW_DATABASE_URI'] = 'sqlite:///' + abspath(path)
+    import main
+    with main.app.test_request_context():
+        return main.planQueries()
+
+
+def plans(con):
+    # -> [(name, plan, whether it keeps off PLAN_CHECKS' forbidden words)]
+    queries = planQueries(con)
+    checked = []
+    for name, forbidden in PLAN_CHECKS:
+        plan = ' | '.join(row[-1] for row in con.execute(
+            'EXPLAIN QUERY PLAN ' + queries[name]))
+        checked.append((name, plan, not any(
+            word in plan + ' ' for word in forbidden)))
+    return checked
+
+
+def checkPlans(con):
+    # EXPLAIN QUERY PLAN of every PLAN_CHECKS query must use indexes
+    failed = []
+    for name, plan, ok in plans(con):
+        print('%-20s %s %s' % (name, 'ok' if ok else 'FAIL', plan))
+        if not ok:
+            failed.append(name)
+    if failed:
+        raise SystemExit('not index-backed: ' + ', '.join(failed))
+
+
+COMMANDS = {
+    'rebuild-search': rebuildSearch,
+    'check-plans': checkPlans,
+    'analyze': analyze,
+    'rebuild-timeline': rebuildTimeline,
+    'verify-timeline': verifyTimeline,
+}
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Upgrade and maintain vwb.db')
+    parser.add_argument('--db', default='vwb.db', help='database file')
+    parser.add_argument('command', nargs='?', default='migrate',
+                        choices=['migrate'] + list(COMMANDS))
+    args = parser.parse_args()
+    if args.command == 'migrate':
+        migrate(args.db)
+    else:
+        run(args.db, COMMANDS[args.command])
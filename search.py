@@ -0,0 +1,47 @@
+"""Full-text search over news_model through an SQLite FTS5 index.
+
+news_fts is an external-content table: it stores only the index, and
+triggers on news_model keep it in step with inserts, updates and deletes.
+"""
+import re
+
+
+NEWS_FTS_DDL = [
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS news_fts USING fts5(
+           title, content, content='news_model', content_rowid='id')''',
+    '''CREATE TRIGGER IF NOT EXISTS news_fts_ai AFTER INSERT ON news_model
+       BEGIN
+           INSERT INTO news_fts (rowid, title, content)
+           VALUES (new.id, new.title, new.content);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS news_fts_ad AFTER DELETE ON news_model
+       BEGIN
+           INSERT INTO news_fts (news_fts, rowid, title, content)
+           VALUES ('delete', old.id, old.title, old.content);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS news_fts_au AFTER UPDATE ON news_model
+       BEGIN
+           INSERT INTO news_fts (news_fts, rowid, title, content)
+           VALUES ('delete', old.id, old.title, old.content);
+           INSERT INTO news_fts (rowid, title, content)
+           VALUES (new.id, new.title, new.content);
+       END''',
+]
+NEWS_FTS_DROP = 'DROP TABLE IF EXISTS news_fts'
+NEWS_FTS_REBUILD = "INSERT INTO news_fts (news_fts) VALUES ('rebuild')"
+
+# best matches first, without the viewer's hidden posts
+NEWS_FTS_SEARCH = '''
+    SELECT rowid FROM news_fts
+    WHERE news_fts MATCH :query AND rowid NOT IN (
+        SELECT news_id FROM hidden_post_model WHERE user_id = :user_id)
+    ORDER BY rank LIMIT :limit OFFSET :offset'''
+
+
+def ftsQuery(text):
+    # every word must match, the last one as a prefix; quoting keeps
+    # FTS5 operators typed by users from being interpreted
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    return ' '.join('"%s"' % word for word in words) + '*'
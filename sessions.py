@@ -0,0 +1,210 @@
+"""Server-side sessions.
+
+The cookie only carries a random session id; the session itself is kept as
+a JSON string in a store, which is written back when its content changed or,
+to keep active users logged in, when it was last written more than
+touch_interval seconds ago. regenerate() moves the session to a fresh id
+(call it on login). Stores share one small interface: get(sid),
+set(sid, data, ttl) and delete(sid).
+"""
+from json import dumps, loads
+from secrets import token_urlsafe
+from threading import Lock, local
+from time import time
+import sqlite3
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+
+# stored next to the session's keys, never part of the session itself
+TOUCHED = '_touched'
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, data=None, touched=0):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        # serialized form as loaded, to tell whether a write is needed
+        self.data = data
+        # when the store entry's ttl was last renewed
+        self.touched = touched
+        # a previous id to delete from the store, see regenerate
+        self.old_sid = None
+        self.modified = False
+
+    def regenerate(self):
+        # against session fixation: the content moves to a new id
+        if self.sid is not None:
+            self.old_sid = self.sid
+            self.sid = None
+        self.modified = True
+
+
+class MemoryStore:
+    # single process only; expired entries are swept on writes
+    def __init__(self, sweep_every=1000):
+        self.items = {}
+        self.lock = Lock()
+        self.sweep_every = sweep_every
+        self.writes = 0
+
+    def get(self, sid):
+        item = self.items.get(sid)
+        if item and item[1] > time():
+            return item[0]
+        return None
+
+    def set(self, sid, data, ttl):
+        with self.lock:
+            self.items[sid] = (data, time() + ttl)
+            self.writes += 1
+            if self.writes % self.sweep_every == 0:
+                now = time()
+                for key in [key for key, item in self.items.items()
+                            if item[1] <= now]:
+                    del self.items[key]
+
+    def delete(self, sid):
+        with self.lock:
+            self.items.pop(sid, None)
+
+
+class SqliteStore:
+    # shared by every worker process that opens the same file
+    def __init__(self, path, sweep_every=1000):
+        self.path = path
+        self.connections = local()
+        self.sweep_every = sweep_every
+        self.writes = 0
+        self.connect().execute('''
+            CREATE TABLE IF NOT EXISTS session (
+                sid VARCHAR(64) PRIMARY KEY,
+                data TEXT NOT NULL,
+                expires REAL NOT NULL
+            )''')
+
+    def connect(self):
+        con = getattr(self.connections, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.path, timeout=10,
+                                  isolation_level=None)
+            con.execute('PRAGMA journal_mode=WAL')
+            self.connections.con = con
+        return con
+
+    def get(self, sid):
+        row = self.connect().execute(
+            'SELECT data FROM session WHERE sid = ? AND expires > ?',
+            (sid, time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, sid, data, ttl):
+        con = self.connect()
+        con.execute('INSERT OR REPLACE INTO session VALUES (?, ?, ?)',
+                    (sid, data, time() + ttl))
+        self.writes += 1
+        if self.writes % self.sweep_every == 0:
+            con.execute('DELETE FROM session WHERE expires <= ?', (time(),))
+
+    def delete(self, sid):
+        self.connect().execute('DELETE FROM session WHERE sid = ?', (sid,))
+
+
+class LocalKV:
+    # in-process stand-in with the get/setex/delete subset of redis.Redis
+    def __init__(self):
+        self.memory = MemoryStore()
+
+    def get(self, key):
+        data = self.memory.get(key)
+        return data.encode() if data is not None else None
+
+    def setex(self, key, ttl, value):
+        self.memory.set(key, value, ttl)
+
+    def delete(self, key):
+        self.memory.delete(key)
+
+
+class KVStore:
+    # any client with redis-style get/setex/delete, e.g. redis.Redis()
+    def __init__(self, client, prefix='vw:session:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, sid):
+        data = self.client.get(self.prefix + sid)
+        return data.decode() if data is not None else None
+
+    def set(self, sid, data, ttl):
+        self.client.setex(self.prefix + sid, int(ttl), data)
+
+    def delete(self, sid):
+        self.client.delete(self.prefix + sid)
+
+
+def makeStore(config):
+    kind = config['SESSION_STORE']
+    if kind == 'sqlite':
+        return SqliteStore(config['SESSION_DB'])
+    elif kind == 'memory':
+        return MemoryStore()
+    elif kind == 'kv':
+        return KVStore(LocalKV())
+    raise ValueError('Unknown SESSION_STORE: ' + str(kind))
+
+
+class ServerSessionInterface(SessionInterface):
+    def __init__(self, store, touch_interval=3600):
+        self.store = store
+        self.touch_interval = touch_interval
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            stored = self.store.get(sid)
+            if stored is not None:
+                content = loads(stored)
+                touched = content.pop(TOUCHED, 0)
+                return ServerSession(content, sid,
+                                     dumps(content, sort_keys=True), touched)
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.old_sid is not None:
+            self.store.delete(session.old_sid)
+            if not session:
+                response.delete_cookie(name, domain=domain, path=path)
+            session.old_sid = None
+        if not session:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        data = dumps(dict(session), sort_keys=True)
+        now = time()
+        stale = now - session.touched >= self.touch_interval
+        if data == session.data and session.sid is not None and not stale:
+            return
+        ttl = app.permanent_session_lifetime.total_seconds()
+        new = session.sid is None
+        if new:
+            session.sid = token_urlsafe(32)
+        content = dict(session)
+        content[TOUCHED] = int(now)
+        self.store.set(session.sid, dumps(content, sort_keys=True), ttl)
+        session.data = data
+        session.touched = int(now)
+        # permanent cookies carry an expiry that has to move along
+        if new or session.permanent:
+            response.set_cookie(
+                name, session.sid, expires=self.get_expiration_time(
+                    app, session), httponly=self.get_cookie_httponly(app),
+                domain=domain, path=path, secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app))
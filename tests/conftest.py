@@ -0,0 +1,52 @@
+from os import environ
+from os.path import abspath, dirname, join
+from tempfile import mkdtemp
+import sys
+
+import pytest
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, ROOT)
+# main reads these on import
+environ['VW_DATABASE_URI'] = 'sqlite:///' + join(mkdtemp(prefix='vw-test-'),
+                                                 'test.db')
+environ.setdefault('VW_LOG_LEVEL', 'WARNING')
+
+import main as vw  # noqa: E402
+
+
+NEWS_COUNT = 45
+
+
+@pytest.fixture(scope='session')
+def app():
+    vw.app.config['WTF_CSRF_ENABLED'] = False
+    vw.app.config['SESSION_STORE'] = 'memory'
+    vw.app.session_interface = vw.ServerSessionInterface(
+        vw.makeStore(vw.app.config))
+    with vw.app.app_context():
+        vw.makeDefUsers(True)
+    client = vw.app.test_client()
+    login(client, 'qwe', 'rty')
+    for number in range(NEWS_COUNT):
+        client.post('/add_news', data={'title': 'news %d' % number,
+                                       'content': 'text %d' % number})
+    settle()
+    return vw.app
+
+
+def login(client, username, password):
+    client.post('/login', data={'username': username,
+                                'password': password})
+    return client
+
+
+def settle():
+    # waits for background timeline and hidden post writes
+    vw.timeline_pool.submit(lambda: None).result()
+    vw.hidden_buffer.flush()
+
+
+@pytest.fixture
+def client(app):
+    return login(app.test_client(), 'admin', 'admin')
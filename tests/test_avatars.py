@@ -0,0 +1,16 @@
+from os.path import exists, join
+
+import avatars
+import main as vw
+
+
+def test_still_avatar_written_without_pillow(tmp_path, monkeypatch):
+    monkeypatch.setattr(avatars, 'Image', None)
+    src = tmp_path / 'upload'
+    src.write_bytes(b'GIF89a not really decoded')
+    name, av_type = avatars.processAvatar(str(src), str(tmp_path), 'gif')
+    assert av_type == 'gif'
+    user = vw.UsersModel(av_path=join(str(tmp_path), name), av_type=av_type)
+    for size in avatars.AVATAR_SIZES:
+        assert exists(vw.getAvat(user, size))
+        assert exists(vw.getAvat(user, size, still=True))
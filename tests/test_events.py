@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+import main as vw
+from asgi import AsgiApp
+
+
+@pytest.fixture
+def serve(client):
+    # runs requests through the ASGI bridge with two threads and a cookie
+    cookie = ('session=' + client.get_cookie('session').value).encode()
+    application = AsgiApp(vw.app, workers=2)
+
+    async def request(path, gone):
+        sent = []
+
+        async def receive():
+            if not sent:
+                sent.append(True)
+                return {'type': 'http.request', 'body': b''}
+            await gone.wait()
+            return {'type': 'http.disconnect'}
+
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        await application({'type': 'http', 'method': 'GET', 'path': path,
+                           'query_string': b'',
+                           'headers': [(b'cookie', cookie)]}, receive, send)
+        return messages
+
+    yield request
+    application.executor.shutdown()
+
+
+def test_event_streams_hold_no_threads(serve, monkeypatch):
+    monkeypatch.setattr(vw.event_hub, 'max_subscribers', 3)
+
+    async def run():
+        gone = asyncio.Event()
+        streams = [asyncio.ensure_future(serve('/events', gone))
+                   for _ in range(3)]
+        await asyncio.sleep(0.2)
+        page = await asyncio.wait_for(serve('/sitemap', gone), 5)
+        full = await asyncio.wait_for(serve('/events', gone), 5)
+        vw.broker.publish({'type': 'news', 'id': 99, 'user_id': 2})
+        await asyncio.sleep(0.1)
+        gone.set()
+        return page, full, await asyncio.wait_for(asyncio.gather(*streams), 5)
+
+    page, full, streams = asyncio.run(run())
+    assert page[0]['status'] == 200
+    assert full[0]['status'] == 503
+    for messages in streams:
+        assert b'event: news' in b''.join(m.get('body', b'')
+                                          for m in messages[1:])
+    assert vw.event_hub.subscribers == set()
+
+
+def test_streamed_page_over_asgi(serve):
+    async def run():
+        return await asyncio.wait_for(serve('/index', asyncio.Event()), 5)
+
+    messages = asyncio.run(run())
+    assert messages[0]['status'] == 200
+    body = b''.join(m.get('body', b'') for m in messages[1:])
+    assert b'/hide_news/' in body
+    assert body.rstrip().endswith(b'</html>')
+
+
+def test_bridge_refuses_oversized_bodies():
+    application = AsgiApp(vw.app, workers=1, max_body=1000)
+    received = []
+
+    async def receive():
+        # a chunked upload that never ends
+        received.append(True)
+        return {'type': 'http.request', 'body': b'x' * 300,
+                'more_body': True}
+
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(application({'type': 'http', 'method': 'POST',
+                             'path': '/settings', 'query_string': b'',
+                             'headers': []}, receive, send))
+    application.executor.shutdown()
+    assert messages[0]['status'] == 413
+    assert len(received) == 4
@@ -0,0 +1,41 @@
+import re
+
+import pytest
+
+import main as vw
+from metrics import metrics
+
+
+@pytest.fixture
+def profiled(app):
+    app.config['METRICS_ENABLED'] = True
+    yield app
+    app.config['METRICS_ENABLED'] = False
+    app.config['METRICS_SERVER_TIMING'] = False
+
+
+def test_streamed_page_recorded_on_close(profiled, client):
+    before = metrics.routes['index'].queries
+    response = client.get('/index')
+    assert response.is_streamed
+    assert 'news' in response.get_data(as_text=True)
+    response.close()
+    assert metrics.routes['index'].queries > before
+
+
+def test_streamed_page_server_timing(profiled, client):
+    profiled.config['METRICS_SERVER_TIMING'] = True
+    response = client.get('/index')
+    timing = response.headers['Server-Timing']
+    queries = int(re.search(r'desc="(\d+) queries"', timing).group(1))
+    assert queries > 0
+    assert re.search(r'tpl;dur=(\d+\.\d+)', timing).group(1) != '0.00'
+
+
+def test_event_stream_not_collected(profiled, client):
+    profiled.config['METRICS_SERVER_TIMING'] = True
+    response = client.get('/events', buffered=False)
+    assert response.mimetype == 'text/event-stream'
+    assert next(response.response).startswith(b'retry:')
+    response.close()
+    assert vw.event_hub.subscribers == set()
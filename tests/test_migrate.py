@@ -0,0 +1,68 @@
+import sqlite3
+
+import pytest
+from sqlalchemy import text
+
+import main as vw
+import migrate
+from migrate import ANALYZE_MIN_NEWS, MIGRATIONS
+
+
+def test_new_database_starts_at_latest_migration(app):
+    with app.app_context():
+        version = vw.db.session.execute(text('PRAGMA user_version')).scalar()
+    assert version == len(MIGRATIONS)
+
+
+@pytest.fixture
+def seeded(app, tmp_path):
+    # a copy of the test database grown past ANALYZE_MIN_NEWS
+    con = sqlite3.connect(str(tmp_path / 'seeded.db'), isolation_level=None)
+    with app.app_context():
+        sqlite3.connect(vw.db.engine.url.database).backup(con)
+    con.execute('BEGIN')
+    con.execute('''
+        WITH RECURSIVE n(i) AS (SELECT 3 UNION ALL SELECT i + 1 FROM n
+                                WHERE i < 200)
+        INSERT INTO users_model (id, user_name, password_hash, fraction,
+                                 regdate, av_type, post_count, has_timeline,
+                                 feed_version, timeline_floor)
+        SELECT i, 'user' || i, '', 'Орда', datetime('now'), '', 0, 0, 0, 0
+        FROM n''')
+    con.execute('''
+        WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n
+                                WHERE i < :count)
+        INSERT INTO news_model (title, content, user_id, user_name, date,
+                                fraction, bgpic)
+        SELECT 'seeded ' || i, 'text', 1 + i % 200, 'user',
+               datetime('now'), 'A', 'primary' FROM n''',
+                {'count': 2 * ANALYZE_MIN_NEWS})
+    con.execute('''
+        INSERT INTO guild_model (user_id, member_id)
+        SELECT id, id % 200 + 1 FROM users_model UNION
+        SELECT id % 200 + 1, id FROM users_model''')
+    con.execute('''
+        INSERT OR IGNORE INTO timeline_model (user_id, news_id, title)
+        SELECT 1, id, title FROM news_model ORDER BY id DESC LIMIT 1000''')
+    con.execute('''
+        INSERT OR IGNORE INTO hidden_post_model (user_id, news_id)
+        SELECT 1 + id % 200, id FROM news_model WHERE id % 5 = 0''')
+    con.execute('COMMIT')
+    yield con
+    con.close()
+
+
+def test_plans_index_backed_after_analyze(seeded):
+    migrate.analyze(seeded)
+    assert seeded.execute('SELECT count(*) FROM sqlite_stat1').fetchone()[0]
+    assert [(name, plan) for name, plan, ok in migrate.plans(seeded)
+            if not ok] == []
+
+
+def test_small_database_goes_without_statistics(seeded):
+    seeded.execute('ANALYZE')
+    seeded.execute('DELETE FROM news_model')
+    migrate.analyze(seeded)
+    assert seeded.execute('SELECT count(*) FROM sqlite_stat1').fetchone()[0] \
+        == 0
+    assert all(ok for name, plan, ok in migrate.plans(seeded))
@@ -0,0 +1,49 @@
+from datetime import datetime
+
+import main as vw
+
+
+def test_reverse_feed_keeps_hide_links(client):
+    for sort_type in ('straight', 'reverse'):
+        client.get('/sort_news/' + sort_type)
+        page = client.get('/index').get_data(as_text=True)
+        # every post in the seeded feed is qwe's, the client is admin
+        assert '/delete_news/' not in page
+        assert '/hide_news/' in page
+    client.get('/sort_news/straight')
+
+
+class Deferred:
+    # stands in for timeline_pool: holds the fan-out back
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, fn, *args):
+        self.calls.append((fn, args))
+
+
+def test_own_post_in_feed_before_fan_out(client, monkeypatch):
+    pool = Deferred()
+    monkeypatch.setattr(vw, 'timeline_pool', pool)
+    client.post('/add_news', data={'title': 'straight away',
+                                   'content': 'mine'})
+    assert pool.calls
+    client.get('/sort_news/id')
+    client.get('/sort_news/reverse')
+    assert 'straight away' in client.get('/index').get_data(as_text=True)
+    for fn, args in pool.calls:
+        fn(*args)
+
+
+def test_card_cache_tells_reused_ids_apart(app):
+    first = vw.NewsModel(id=10 ** 6, title='deleted', content='gone',
+                         user_id=1, user_name='admin',
+                         date=datetime(2020, 1, 1), fraction='A',
+                         bgpic='primary')
+    second = vw.NewsModel(id=10 ** 6, title='reused', content='new',
+                          user_id=1, user_name='admin',
+                          date=datetime(2020, 1, 2), fraction='A',
+                          bgpic='primary')
+    with app.test_request_context():
+        assert 'deleted' in vw.newsCard(first, 'search')
+        assert 'reused' in vw.newsCard(second, 'search')
@@ -0,0 +1,39 @@
+import pytest
+
+import main as vw
+from conftest import settle
+
+
+@pytest.fixture
+def viewer(client):
+    client.get('/hide_news/3')
+    settle()
+    return client
+
+
+def budgeted(client, url, limit):
+    # streamed pages query while the body is read, so read it in the budget
+    with vw.queryBudget(limit):
+        response = client.get(url)
+        body = response.get_data()
+        response.close()
+    assert response.status_code == 200
+    return body
+
+
+@pytest.mark.parametrize('url, limit', [
+    ('/index', 2),
+    ('/index?after=30', 3),
+    ('/wid0', 5),
+    ('/wid2', 6),
+    ('/hidden', 2),
+    ('/search?q=news', 2),
+    ('/api/v1/news', 3),
+])
+def test_query_budget(viewer, url, limit):
+    assert budgeted(viewer, url, limit)
+
+
+def test_budget_counts_streamed_body(viewer):
+    with pytest.raises(AssertionError, match='over a budget'):
+        budgeted(viewer, '/index', 1)
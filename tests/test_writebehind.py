@@ -0,0 +1,47 @@
+import logging
+
+from writebehind import WriteBehind
+
+
+class Flaky:
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+        self.written = {}
+
+    def __call__(self, pending):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise OSError('database is locked')
+        for key, items in pending.items():
+            self.written.setdefault(key, set()).update(items)
+
+
+def test_failed_flush_retries_a_bounded_number_of_times(monkeypatch):
+    write = Flaky(failures=10)
+    buffer = WriteBehind(write, delay=0, retries=2)
+    waits = []
+    monkeypatch.setattr(buffer, 'schedule', waits.append)
+    buffer.add(1, 5)
+    buffer.flush()
+    buffer.flush()
+    assert waits == [1, 2]
+    assert buffer.get(1) == {5}
+    write.failures = 0
+    buffer.add(1, 6)
+    assert write.written == {1: {5, 6}}
+    assert buffer.failures == 0
+
+
+def test_close_logs_what_it_could_not_write(caplog):
+    buffer = WriteBehind(Flaky(failures=1), delay=60)
+    buffer.add(7, 3)
+    with caplog.at_level(logging.ERROR):
+        buffer.close()
+    assert "Write-behind lost 7: 3" in caplog.text
+
+
+def test_versions_differ_between_processes():
+    first = WriteBehind(Flaky(failures=0), delay=0)
+    second = WriteBehind(Flaky(failures=0), delay=0)
+    assert first.version(1) != second.version(1)
@@ -0,0 +1,120 @@
+"""Write-behind buffer for small, frequent writes.
+
+Items are collected per key (e.g. the news ids a user hid) and handed to
+flush({key: set of items}) delay seconds after the first one arrived, so a
+burst of actions costs one write transaction instead of one each. Readers
+overlay pending(key) on what the database returns.
+
+A failed flush puts its items back and is retried up to retries times,
+waiting twice as long each time; after that the items wait for the next
+add. Whatever is still pending when the process exits normally is flushed
+by an atexit hook, and logged item by item if that fails too. Items only
+live in memory until then, so a killed process loses them.
+"""
+from atexit import register
+from secrets import token_hex
+from threading import Lock, Timer
+import logging
+
+
+class WriteBehind:
+    def __init__(self, flush, delay=0.5, retries=5):
+        self.write = flush
+        self.delay = delay
+        self.retries = retries
+        self.failures = 0
+        self.pending = {}
+        # taken out of pending by a running flush, not committed yet
+        self.flushing = {}
+        # per-key change counters, part of cache validators (see feedEtag);
+        # they start over with every process, hence the instance token
+        self.versions = {}
+        self.instance = token_hex(4)
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.timer = None
+        register(self.close)
+
+    def add(self, key, item):
+        with self.lock:
+            self.pending.setdefault(key, set()).add(item)
+            self.versions[key] = self.versions.get(key, 0) + 1
+            if self.timer is None and self.delay:
+                self.schedule(self.delay)
+        if not self.delay:
+            self.flush()
+
+    def schedule(self, delay):
+        # under self.lock
+        self.timer = Timer(delay, self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def discard(self, key, item):
+        # -> whether the item was still pending, i.e. never written
+        with self.lock:
+            items = self.pending.get(key)
+            if not items or item not in items:
+                return False
+            items.discard(item)
+            if not items:
+                del self.pending[key]
+            self.versions[key] = self.versions.get(key, 0) + 1
+            return True
+
+    def get(self, key):
+        with self.lock:
+            return frozenset(self.pending.get(key, ())) | \
+                frozenset(self.flushing.get(key, ()))
+
+    def settle(self):
+        # waits for a running flush, so direct writes can't be overtaken
+        with self.flush_lock:
+            pass
+
+    def version(self, key):
+        with self.lock:
+            return '%s-%d' % (self.instance, self.versions.get(key, 0))
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pending = self.flushing = self.pending
+                self.pending = {}
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+            if not pending:
+                return True
+            try:
+                self.write(pending)
+            except Exception:
+                with self.lock:
+                    for key, items in pending.items():
+                        self.pending.setdefault(key, set()).update(items)
+                    self.failures += 1
+                    if self.failures > self.retries:
+                        logging.exception(
+                            'Write-behind flush failed %d times, waiting '
+                            'for the next write', self.failures)
+                    elif self.timer is None:
+                        # write-through (delay 0) retries after a second
+                        wait = (self.delay or 1) * 2 ** (self.failures - 1)
+                        logging.exception(
+                            'Write-behind flush failed, retrying in %gs',
+                            wait)
+                        self.schedule(wait)
+                return False
+            else:
+                self.failures = 0
+                return True
+            finally:
+                with self.lock:
+                    self.flushing = {}
+
+    def close(self):
+        # atexit: the last chance to write, so failures are logged in full
+        if not self.flush():
+            for key, items in self.pending.items():
+                for item in sorted(items):
+                    logging.error('Write-behind lost %r: %r', key, item)